@@ -2,13 +2,17 @@
 set -e
 case $1 in
     worker)
-    exec celery -A guoku_crawler worker -l info
+    exec celery -A guoku_crawler worker -l info --concurrency=$(python -c 'from guoku_crawler import config; print(config.CELERYD_NETWORK_CONCURRENCY)')
     ;;
 
     cookie_worker)
     exec celery -A guoku_crawler worker -l info -Q cookies
     ;;
 
+    image_worker)
+    exec celery -A guoku_crawler worker -l info -Q images --concurrency=$(nproc)
+    ;;
+
     beat)
 	exec celery -A guoku_crawler beat -l debug
     ;;
@@ -5,4 +5,10 @@ from .client import update_sogou_cookie
 from .crawler import crawl_articles
 from .rss import crawl_rss_list, crawl_rss_images
 from .weixin import crawl_weixin_list, crawl_weixin_article
-from .weixin import prepare_sogou_cookies
+from .weixin import prepare_sogou_cookies, refresh_sogou_cookies
+from .weixin import prewarm_profile_links
+
+from guoku_crawler import config
+if config.BENCH_METRICS:
+    from guoku_crawler.bench import metrics
+    metrics.install()
@@ -5,7 +5,8 @@ import json
 import random
 import requests
 
-from time import sleep
+from hashlib import md5
+
 from faker import Faker
 from urlparse import urljoin
 
@@ -16,6 +17,10 @@ from requests.exceptions import ConnectionError
 from guoku_crawler.db import r
 from guoku_crawler import config
 from guoku_crawler.celery import RequestsTask, app
+from guoku_crawler.bench.cassette import get_hooks
+from guoku_crawler.article.cookies import cookie_pool
+from guoku_crawler.common.breaker import default_breaker
+from guoku_crawler.common.throttle import default_throttle
 from guoku_crawler.exceptions import TooManyRequests, Expired, Retry
 
 
@@ -23,6 +28,14 @@ faker = Faker()
 
 
 class BaseClient(requests.Session):
+    throttle = default_throttle
+    breaker = default_breaker
+
+    def __init__(self):
+        super(BaseClient, self).__init__()
+        for event, hooks in get_hooks().items():
+            self.hooks[event].extend(hooks)
+
     def request(self, method, url,
                 params=None,
                 data=None,
@@ -39,6 +52,8 @@ class BaseClient(requests.Session):
                 cert=None,
                 json=None):
         resp = None
+        self.breaker.before_request(url)
+        self.throttle.reserve(url)
         try:
             resp = super(BaseClient, self).request(method, url, params, data,
                                                    headers, cookies, files,
@@ -48,21 +63,74 @@ class BaseClient(requests.Session):
                                                    cert, json)
 
         except ConnectionError as e:
+            self.breaker.record_failure(url)
             raise Retry(message=u'ConnectionError. %s' % e)
         except ReadTimeout as e:
+            self.breaker.record_failure(url)
             raise Retry(message=u'ReadTimeout. %s' % e)
         except BaseException as e:
             logger.error(e)
+            raise
+        self.breaker.record(url, resp)
         if stream:
             return resp
         resp.utf8_content = resp.content.decode('utf-8')
         resp.utf8_content = resp.utf8_content.rstrip('\n')
-        sleep(config.REQUEST_INTERVAL)
         return resp
 
 
 class RSSClient(BaseClient):
-    pass
+    """
+    Feeds are fetched with conditional GET. ETag, Last-Modified and a hash of
+    the body are kept per feed url in redis, so an unchanged feed costs a 304
+    (or at worst a download) but never a parse.
+    """
+
+    @staticmethod
+    def get_cache_key(url):
+        return 'rss.cache.%s' % url
+
+    def get_feed(self, url, params=None):
+        """
+        Returns the feed response, or None if the feed has not changed since
+        it was last remembered with `remember_feed`.
+        """
+        url = requests.Request('GET', url, params=params).prepare().url
+        cache_key = self.get_cache_key(url)
+        cached = r.hgetall(cache_key)
+        headers = {}
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        resp = self.get(url, headers=headers)
+        if resp.status_code == 304:
+            logger.info('feed not modified: %s', url)
+            return None
+        resp.cache_key = cache_key
+        resp.content_hash = md5(resp.content).hexdigest()
+        if resp.content_hash == cached.get('hash'):
+            logger.info('feed content unchanged: %s', url)
+            return None
+        return resp
+
+    def remember_feed(self, resp):
+        """
+        Store the validators of a feed once it has been fully processed.
+        """
+        if resp.status_code != 200:
+            return
+        key = resp.cache_key
+        validators = {
+            'etag': resp.headers.get('ETag', ''),
+            'last_modified': resp.headers.get('Last-Modified', ''),
+            'hash': resp.content_hash,
+        }
+        pipe = r.pipeline()
+        pipe.hmset(key, validators)
+        pipe.expire(key, config.RSS_CACHE_TTL)
+        pipe.execute()
 
 
 class WeiXinClient(BaseClient):
@@ -102,12 +170,19 @@ class WeiXinClient(BaseClient):
         if stream:
             return resp
 
+        self.check_response(resp, url, jsonp_callback)
+        return resp
+
+    def check_response(self, resp, url, jsonp_callback=None):
         # catch exceptions
         if resp.utf8_content.find(u'您的访问过于频繁') >= 0:
             message = u'您的访问过于频繁,需要输入验证码. user: %s, url: %s' % (
                 self.sg_user, url)
             # logger.warning(message)
             logger.warning(u'访问过于频繁, cookie: %s' % resp.request.headers)
+            if self.sg_user:
+                self.quarantine_cookie()
+                self._sg_user = None
             raise TooManyRequests(message)
         if resp.utf8_content.find(u'当前请求已过期') >= 0:
             message = u'当前请求已过期: %s' % url
@@ -118,53 +193,46 @@ class WeiXinClient(BaseClient):
             resp.jsonp = self.parse_jsonp(resp.utf8_content, jsonp_callback)
             if resp.status_code > 400:
                 # raise Exception('404')
-                return resp
+                return
             if resp.jsonp.get('code') == 'needlogin':
                 self.refresh_cookies()
                 raise Retry(message=u'need login with %s.' % self.sg_user)
-        sleep(config.REQUEST_INTERVAL)
-        return resp
+        if self.sg_user:
+            cookie_pool.checkin(self.sg_user)
 
     def refresh_cookies(self, update=False):
+        """
+        Switch to the next cookie of the pool. With `update`, the current
+        cookie is known to be bad: its user is quarantined and a new cookie
+        is requested for it once the quarantine is over.
+        """
         self.cookies.clear()
-        if update:
-            update_sogou_cookie.delay(self.sg_user)
-            logger.info('WeiXinClient().refresh_cookies: call update_sogou_cookie.delay for user: %s' % self.sg_user)
+        if self.sg_user and update:
+            self.quarantine_cookie()
 
-        sg_users = list(config.SOGOU_USERS)
-        if self.sg_user:
-            sg_users.remove(self.sg_user)
-
-        sg_user = random.choice(sg_users)
-        sg_cookie = r.get('sogou.cookie.%s' % sg_user)
-        if not sg_cookie:
-            update_sogou_cookie.delay(sg_user)
-            logger.info('WeiXinClient().refresh_cookies while loop: call update_sogou_cookie.delay for user: %s' % sg_user)
-            # sg_user = random.choice(sg_users)
-            try:
-                for sg_user in sg_users:
-                    try:
-                        sg_cookie = r.get('sogou.cookie.%s' % sg_user).decode()
-                        logger.info('WeiXinClient().refresh_cookies while loop: got cookie from redis, user: %s' % sg_user)
-                        break
-                    except:
-                        pass
-            except:
-                sg_user = random.choice(sg_users)
-                update_sogou_cookie(sg_user)
-
-
-            # except Exception as e:
-            #     logger.error('WeiXinClient().refresh_cookies while loop: %s' % e)
-            #     sleep(10)
-            #     pass
+        sg_user, sg_cookie = cookie_pool.checkout()
+        if not sg_user:
+            logger.warning('WeiXinClient().refresh_cookies: cookie pool is '
+                           'empty')
+            sg_users = list(config.SOGOU_USERS)
+            random.shuffle(sg_users)
+            for sg_user in sg_users:
+                if schedule_cookie_refresh(sg_user) is not None:
+                    break
+            raise Retry(countdown=60, message=u'no sogou cookie available.')
 
         self._sg_user = sg_user
         self.headers['Cookie'] = sg_cookie
         self.headers['User-Agent'] = faker.user_agent()
-        # logger.info("have updated cookies for %s" % self.sg_user)
         logger.info("weixin_client.Cookie: %s" % self.headers['Cookie'])
 
+    def quarantine_cookie(self):
+        cookie_pool.quarantine(self.sg_user)
+        # claim the renewal so refresh_sogou_cookies doesn't schedule another
+        schedule_cookie_refresh(self.sg_user, config.SOGOU_COOKIE_QUARANTINE)
+        logger.info('WeiXinClient().quarantine_cookie: quarantined %s'
+                    % self.sg_user)
+
     @classmethod
     def parse_jsonp(cls, utf8_content, callback):
         if utf8_content.startswith(callback):
@@ -183,15 +251,47 @@ def update_sogou_cookie(sg_user):
     if not sg_user:
         return
     get_url = urljoin(config.PHANTOM_SERVER, '_sg_cookie')
-    resp = requests.post(get_url, data={'email': sg_user})
+    resp = phantom_post(get_url, data={'email': sg_user})
     cookie = resp.json()['sg_cookie']
-    key = 'sogou.cookie.%s' % sg_user
-    r.set(key, cookie)
+    cookie_pool.add(sg_user, cookie)
     logger.info('update_sogou_cookie: update cookie SUCCESS for %s: , cookie: %s, have saved to redis.' % (sg_user, cookie))
 
 
+def schedule_cookie_refresh(sg_user, delay=0):
+    """
+    Renew the cookie of `sg_user` in the next free phantom slot at least
+    `delay` seconds away. Returns the countdown, None when a renewal is
+    scheduled already.
+    """
+    countdown = cookie_pool.claim_refresh(sg_user, delay)
+    if countdown is not None:
+        update_sogou_cookie.apply_async((sg_user,), countdown=countdown)
+    return countdown
+
+
 def get_user_profile_link(weixin_id):
     get_url = urljoin(config.PHANTOM_SERVER, 'userlink')
     params = dict(type='1', ie='utf8', query=weixin_id)
-    resp = requests.post(get_url, params=params)
+    resp = phantom_post(get_url, params=params)
+    return resp
+
+
+def phantom_get(url, **kwargs):
+    return phantom_request('GET', url, **kwargs)
+
+
+def phantom_post(url, **kwargs):
+    return phantom_request('POST', url, **kwargs)
+
+
+def phantom_request(method, url, **kwargs):
+    # the phantom server drives a headless browser; when it is down, defer
+    # instead of queueing more work for it.
+    default_breaker.before_request(url)
+    try:
+        resp = requests.request(method, url, hooks=get_hooks(), **kwargs)
+    except (requests.ConnectionError, requests.Timeout):
+        default_breaker.record_failure(url)
+        raise
+    default_breaker.record(url, resp)
     return resp
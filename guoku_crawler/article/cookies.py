@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import time
+
+from guoku_crawler import config
+from guoku_crawler.db import r
+
+
+POOL_KEY = 'sogou.cookie.pool'
+QUARANTINE_KEY = 'sogou.cookie.quarantine'
+LIFETIME_KEY = 'sogou.cookie.lifetime'
+COOKIE_PREFIX = 'sogou.cookie.'
+STATS_PREFIX = 'sogou.cookie.stats.'
+REFRESHING_PREFIX = 'sogou.cookie.refreshing.'
+LOGIN_SLOT_KEY = 'sogou.cookie.login_slot'
+
+# KEYS: pool, quarantine. ARGV: now, cookie prefix, stats prefix, health
+# penalty, age weight. Releases users whose quarantine is over, then checks
+# out the user with the lowest score and pushes it to the back of the pool.
+# Users whose cookie is gone are dropped from the pool on the way.
+CHECKOUT_SCRIPT = """
+local now = tonumber(ARGV[1])
+for _, user in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    redis.call('ZREM', KEYS[2], user)
+    redis.call('ZADD', KEYS[1], now, user)
+end
+while true do
+    local picked = redis.call('ZRANGE', KEYS[1], 0, 0)
+    if #picked == 0 then
+        return false
+    end
+    local user = picked[1]
+    local cookie = redis.call('GET', ARGV[2] .. user)
+    if cookie then
+        local stats = ARGV[3] .. user
+        local s = redis.call('HMGET', stats, 'health', 'created')
+        local health = tonumber(s[1]) or 1
+        local created = tonumber(s[2]) or now
+        redis.call('HSET', stats, 'last_used', now)
+        redis.call('ZADD', KEYS[1],
+                   now + (1 - health) * tonumber(ARGV[4]) +
+                   (now - created) * tonumber(ARGV[5]), user)
+        return {user, cookie}
+    end
+    redis.call('ZREM', KEYS[1], user)
+end
+"""
+
+# KEYS: pool, stats of the user. ARGV: user, now, 1 for success or 0 for
+# failure, health smoothing factor, health penalty, age weight. Updates the
+# recent success rate and re-scores the user if it is still in the pool.
+CHECKIN_SCRIPT = """
+local now = tonumber(ARGV[2])
+local ok = tonumber(ARGV[3])
+local alpha = tonumber(ARGV[4])
+local s = redis.call('HMGET', KEYS[2], 'health', 'created', 'last_used')
+local health = (tonumber(s[1]) or 1) * (1 - alpha) + alpha * ok
+local created = tonumber(s[2]) or now
+local last_used = tonumber(s[3]) or now
+redis.call('HSET', KEYS[2], 'health', health)
+if ok == 1 then
+    redis.call('HINCRBY', KEYS[2], 'success', 1)
+else
+    redis.call('HINCRBY', KEYS[2], 'failure', 1)
+end
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZADD', KEYS[1],
+               last_used + (1 - health) * tonumber(ARGV[5]) +
+               (now - created) * tonumber(ARGV[6]), ARGV[1])
+end
+return tostring(health)
+"""
+
+# KEYS: pool, quarantine. ARGV: now, cookie prefix, users. Adds users that
+# have a cookie but are neither pooled nor quarantined, e.g. cookies stored
+# before the pool existed.
+SYNC_SCRIPT = """
+local added = 0
+for i = 3, #ARGV do
+    local user = ARGV[i]
+    if redis.call('EXISTS', ARGV[2] .. user) == 1
+            and not redis.call('ZSCORE', KEYS[1], user)
+            and not redis.call('ZSCORE', KEYS[2], user) then
+        redis.call('ZADD', KEYS[1], tonumber(ARGV[1]), user)
+        added = added + 1
+    end
+end
+return added
+"""
+
+# KEYS: lifetime, stats of the user. ARGV: now, smoothing factor, initial
+# estimate. Folds the age the cookie reached before it went bad into the
+# running estimate of how long sogou cookies live.
+LIFETIME_SCRIPT = """
+local created = tonumber(redis.call('HGET', KEYS[2], 'created'))
+if not created then
+    return false
+end
+local age = tonumber(ARGV[1]) - created
+local alpha = tonumber(ARGV[2])
+local lifetime = tonumber(redis.call('HGET', KEYS[1], 'ewma')) or
+                 tonumber(ARGV[3])
+lifetime = lifetime * (1 - alpha) + age * alpha
+redis.call('HSET', KEYS[1], 'ewma', lifetime)
+redis.call('HINCRBY', KEYS[1], 'samples', 1)
+return tostring(lifetime)
+"""
+
+
+# KEYS: refreshing flag of the user, next login slot. ARGV: now, delay,
+# spacing, refresh interval. Unless a renewal of the user is scheduled
+# already, takes the first login slot at least `delay` seconds away, one
+# every `spacing` seconds across all callers, and returns its countdown.
+CLAIM_REFRESH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return false
+end
+local now = tonumber(ARGV[1])
+local spacing = tonumber(ARGV[3])
+local slot = math.max(now + tonumber(ARGV[2]),
+                      tonumber(redis.call('GET', KEYS[2])) or 0)
+redis.call('SET', KEYS[2], slot + spacing,
+           'EX', math.ceil(slot + spacing - now))
+redis.call('SET', KEYS[1], 1,
+           'EX', math.ceil(slot - now + tonumber(ARGV[4])))
+return tostring(slot - now)
+"""
+
+
+class CookiePool(object):
+    """
+    Sogou cookies of `config.SOGOU_USERS`, rotated least recently used
+    first. The score of a user is its last use plus a penalty for a poor
+    recent success rate and for the age of its cookie, so healthy fresh
+    cookies come round more often. Users whose cookie runs into a captcha
+    are quarantined for a while.
+    """
+
+    def __init__(self, redis_client=r):
+        self.redis = redis_client
+        self.checkout_script = redis_client.register_script(CHECKOUT_SCRIPT)
+        self.checkin_script = redis_client.register_script(CHECKIN_SCRIPT)
+        self.sync_script = redis_client.register_script(SYNC_SCRIPT)
+        self.lifetime_script = redis_client.register_script(LIFETIME_SCRIPT)
+        self.claim_refresh_script = redis_client.register_script(
+            CLAIM_REFRESH_SCRIPT)
+
+    @staticmethod
+    def get_cookie_key(sg_user):
+        return COOKIE_PREFIX + sg_user
+
+    @staticmethod
+    def get_stats_key(sg_user):
+        return STATS_PREFIX + sg_user
+
+    def checkout(self):
+        """
+        Returns (sg_user, cookie), or (None, None) if the pool is empty.
+        """
+        picked = self.checkout_script(
+            keys=[POOL_KEY, QUARANTINE_KEY],
+            args=[time.time(), COOKIE_PREFIX, STATS_PREFIX,
+                  config.SOGOU_COOKIE_HEALTH_PENALTY,
+                  config.SOGOU_COOKIE_AGE_WEIGHT])
+        if not picked:
+            self.sync()
+            return None, None
+        sg_user, cookie = picked
+        return sg_user.decode(), cookie.decode()
+
+    def checkin(self, sg_user, ok=True):
+        return float(self.checkin_script(
+            keys=[POOL_KEY, self.get_stats_key(sg_user)],
+            args=[sg_user, time.time(), 1 if ok else 0,
+                  config.SOGOU_COOKIE_HEALTH_ALPHA,
+                  config.SOGOU_COOKIE_HEALTH_PENALTY,
+                  config.SOGOU_COOKIE_AGE_WEIGHT]))
+
+    def quarantine(self, sg_user, seconds=None):
+        if seconds is None:
+            seconds = config.SOGOU_COOKIE_QUARANTINE
+        self.checkin(sg_user, ok=False)
+        self.observe_lifetime(sg_user)
+        pipe = self.redis.pipeline()
+        pipe.zrem(POOL_KEY, sg_user)
+        pipe.zadd(QUARANTINE_KEY, sg_user, time.time() + seconds)
+        pipe.execute()
+
+    def add(self, sg_user, cookie):
+        """
+        Put a freshly issued cookie in the pool, releasing its user from
+        quarantine.
+        """
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.set(self.get_cookie_key(sg_user), cookie)
+        pipe.hmset(self.get_stats_key(sg_user), {'created': now, 'health': 1})
+        pipe.zrem(QUARANTINE_KEY, sg_user)
+        pipe.zadd(POOL_KEY, sg_user, now)
+        pipe.delete(REFRESHING_PREFIX + sg_user)
+        pipe.execute()
+
+    def sync(self, sg_users=None):
+        return self.sync_script(
+            keys=[POOL_KEY, QUARANTINE_KEY],
+            args=[time.time(), COOKIE_PREFIX] +
+                 list(sg_users or config.SOGOU_USERS))
+
+    def observe_lifetime(self, sg_user):
+        self.lifetime_script(keys=[LIFETIME_KEY, self.get_stats_key(sg_user)],
+                             args=[time.time(),
+                                   config.SOGOU_COOKIE_LIFETIME_ALPHA,
+                                   config.SOGOU_COOKIE_LIFETIME])
+
+    def get_lifetime(self):
+        lifetime = self.redis.hget(LIFETIME_KEY, 'ewma')
+        return float(lifetime or config.SOGOU_COOKIE_LIFETIME)
+
+    def get_ages(self, sg_users):
+        """
+        Returns a dict of sg_user -> age of its cookie in seconds, None for
+        users without a cookie.
+        """
+        pipe = self.redis.pipeline()
+        for sg_user in sg_users:
+            pipe.exists(self.get_cookie_key(sg_user))
+            pipe.hget(self.get_stats_key(sg_user), 'created')
+        replies = pipe.execute()
+        now = time.time()
+        ages = {}
+        for i, sg_user in enumerate(sg_users):
+            exists, created = replies[2 * i], replies[2 * i + 1]
+            if exists and created:
+                ages[sg_user] = now - float(created)
+            else:
+                ages[sg_user] = None
+        return ages
+
+    def claim_refresh(self, sg_user, delay=0):
+        """
+        Mark a renewal of `sg_user` as scheduled in the next free slot of
+        the phantom server at least `delay` seconds away. Returns the
+        countdown of that slot, None if a renewal already is scheduled.
+        """
+        countdown = self.claim_refresh_script(
+            keys=[REFRESHING_PREFIX + sg_user, LOGIN_SLOT_KEY],
+            args=[time.time(), delay, config.PHANTOM_COOKIE_SPACING,
+                  config.SOGOU_COOKIE_REFRESH_INTERVAL])
+        if countdown is None:
+            return None
+        return int(math.ceil(float(countdown)))
+
+
+cookie_pool = CookiePool()
@@ -8,6 +8,7 @@ from guoku_crawler.db import session
 from guoku_crawler.celery import RequestsTask, app
 from guoku_crawler.article.rss import crawl_rss_list
 from guoku_crawler.article.weixin import crawl_weixin_list, prepare_sogou_cookies
+from guoku_crawler.article.weixin import prewarm_profile_links
 from guoku_crawler.models import CoreGkuser, AuthGroup, CoreArticle
 from guoku_crawler.models import CoreAuthorizedUserProfile as Profile
 
@@ -38,6 +39,8 @@ def crawl_articles():
     global AUTH_USER_LIST
     if not AUTH_USER_LIST:
         AUTH_USER_LIST = get_auth_users()
+        # a new round: fetch the profile links it needs in one go
+        prewarm_profile_links.delay()
     crawl_user_articles(AUTH_USER_LIST.pop().profile.id)
 
 
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Which candidate articles are already crawled. A bloom filter answers for
+most of them; the rest are resolved against core_article in one query.
+
+Rebuild the filter from the database with:
+
+    python -m guoku_crawler.article.dedup
+"""
+
+from guoku_crawler import config
+from guoku_crawler.common.bloom import BloomFilter
+from guoku_crawler.config import logger
+from guoku_crawler.db import session, iter_batches
+from guoku_crawler.models import CoreArticle
+
+
+seen_articles = BloomFilter('seen.articles', config.SEEN_ARTICLES_CAPACITY,
+                            config.SEEN_ERROR_RATE)
+
+
+def get_seen_key(creator_id, identity_code):
+    return u'%s:%s' % (creator_id, identity_code)
+
+
+def mark_seen(creator_id, identity_codes):
+    seen_articles.add_many([get_seen_key(creator_id, code)
+                            for code in identity_codes])
+
+
+def get_existing_codes(creator_id, identity_codes):
+    """
+    The subset of `identity_codes` already in core_article for `creator_id`,
+    in one query that only reads the identity_code column.
+    """
+    identity_codes = set(identity_codes)
+    if not identity_codes:
+        return set()
+    rows = session.query(CoreArticle.identity_code).filter(
+        CoreArticle.creator_id == creator_id,
+        CoreArticle.identity_code.in_(identity_codes)
+    ).all()
+    return set(identity_code for (identity_code,) in rows)
+
+
+def filter_new(creator_id, candidates, get_code):
+    """
+    Returns (new candidates, number of existing ones), `get_code` giving
+    the identity_code of a candidate.
+    """
+    codes = [get_code(c) for c in candidates]
+    seen = seen_articles.contains_many([get_seen_key(creator_id, code)
+                                        for code in codes])
+    unknown = [code for code, known in zip(codes, seen) if not known]
+    existing = get_existing_codes(creator_id, unknown)
+    # crawled before the filter knew about it
+    mark_seen(creator_id, existing)
+    existing.update(code for code, known in zip(codes, seen) if known)
+    new = [c for c in candidates if get_code(c) not in existing]
+    return new, len(candidates) - len(new)
+
+
+def rebuild():
+    article_rows = session.query(
+        CoreArticle.id, CoreArticle.creator_id, CoreArticle.identity_code
+    ).filter(CoreArticle.identity_code.isnot(None))
+    articles = seen_articles.rebuild(
+        [get_seen_key(creator_id, code) for _, creator_id, code in rows]
+        for rows in iter_batches(article_rows, CoreArticle.id))
+    logger.info('rebuilt seen filter: %d articles', articles)
+    return articles
+
+
+if __name__ == '__main__':
+    print 'articles: %d' % rebuild()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+from guoku_crawler import config
+from guoku_crawler.config import logger
+from guoku_crawler.article.client import get_user_profile_link
+from guoku_crawler.db import session, r
+from guoku_crawler.exceptions import CircuitOpen
+from guoku_crawler.models import CoreAuthorizedUserProfile as Profile
+
+
+LINK_PREFIX = 'sogou.profile.'
+
+
+class ProfileLinkCache(object):
+    """
+    Sogou profile links and open ids by weixin_id, looked up in this
+    process, then in redis, and only then asked from the phantom server.
+    Entries live until a fetch of the link reports it expired. Open ids the
+    phantom server returns are kept in `Profile.weixin_openid` as well, and
+    read from there when redis has none.
+    """
+
+    def __init__(self, redis_client=r):
+        self.redis = redis_client
+        self._local = {}
+
+    @staticmethod
+    def get_key(weixin_id):
+        return LINK_PREFIX + weixin_id
+
+    def get(self, weixin_id):
+        """
+        Returns (open_id, user_link); user_link is None if unknown.
+        """
+        weixin_id = weixin_id.strip()
+        cached = self._local.get(weixin_id)
+        if cached and cached[2] > time.time():
+            return cached[0], cached[1]
+
+        open_id, user_link = self.redis.hmget(self.get_key(weixin_id),
+                                              'open_id', 'user_link')
+        if not open_id:
+            open_id = self.get_open_id(weixin_id)
+        if not user_link:
+            return open_id, None
+        self.remember(weixin_id, open_id, user_link)
+        return open_id, user_link
+
+    @staticmethod
+    def get_open_id(weixin_id):
+        profile = session.query(Profile.weixin_openid).filter(
+            Profile.weixin_id == weixin_id).first()
+        return profile and profile.weixin_openid or ''
+
+    def remember(self, weixin_id, open_id, user_link):
+        self._local[weixin_id] = (open_id, user_link,
+                                  time.time() + config.PROFILE_LINK_LOCAL_TTL)
+
+    def set(self, weixin_id, open_id, user_link, persist=True):
+        key = self.get_key(weixin_id)
+        pipe = self.redis.pipeline()
+        pipe.hmset(key, {'open_id': open_id or '', 'user_link': user_link})
+        pipe.expire(key, config.PROFILE_LINK_TTL)
+        pipe.execute()
+        self.remember(weixin_id, open_id, user_link)
+        if persist and open_id:
+            session.query(Profile).filter(
+                Profile.weixin_id == weixin_id
+            ).update({'weixin_openid': open_id}, synchronize_session=False)
+            session.commit()
+
+    def invalidate(self, weixin_id):
+        weixin_id = weixin_id.strip()
+        logger.info('ProfileLinkCache().invalidate: %s', weixin_id)
+        self._local.pop(weixin_id, None)
+        self.redis.delete(self.get_key(weixin_id))
+
+    def fetch(self, weixin_id):
+        """
+        Ask the phantom server for the profile link and cache it.
+        """
+        weixin_id = weixin_id.strip()
+        response = get_user_profile_link(weixin_id)
+        tokens = json.loads(response.content)
+        user_link = tokens.get('user_link')
+        if not user_link:
+            logger.warning('cannot find profile link for weixin_id: %s',
+                           weixin_id)
+            return '', None
+        open_id = tokens.get('open_id')
+        if open_id:
+            self.set(weixin_id, open_id, user_link)
+        else:
+            open_id = self.get_open_id(weixin_id)
+            self.set(weixin_id, open_id, user_link, persist=False)
+        return open_id, user_link
+
+    def get_or_fetch(self, weixin_id):
+        open_id, user_link = self.get(weixin_id)
+        if user_link:
+            return open_id, user_link
+        return self.fetch(weixin_id)
+
+    def missing(self, weixin_ids):
+        """
+        The weixin_ids with no profile link in redis.
+        """
+        pipe = self.redis.pipeline()
+        for weixin_id in weixin_ids:
+            pipe.hexists(self.get_key(weixin_id), 'user_link')
+        return [weixin_id for weixin_id, cached
+                in zip(weixin_ids, pipe.execute()) if not cached]
+
+    def prewarm(self, weixin_ids):
+        """
+        Fill redis for the `weixin_ids` it has no link of from the phantom
+        server. Returns how many were filled.
+        """
+        weixin_ids = self.missing([w.strip() for w in weixin_ids if w])
+        fetched = 0
+        for i, weixin_id in enumerate(weixin_ids):
+            try:
+                if self.fetch(weixin_id)[1]:
+                    fetched += 1
+            except CircuitOpen:
+                logger.warning('ProfileLinkCache().prewarm: phantom server '
+                               'is unavailable, %d left cold',
+                               len(weixin_ids) - i)
+                break
+            except Exception as e:
+                logger.error('ProfileLinkCache().prewarm: %s failed: %s',
+                             weixin_id, e)
+        return fetched
+
+
+profile_links = ProfileLinkCache()
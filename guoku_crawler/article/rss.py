@@ -5,12 +5,15 @@ from hashlib import md5
 import datetime
 from bs4 import BeautifulSoup
 from dateutil import parser
-from sqlalchemy.orm.exc import NoResultFound
 
 from guoku_crawler import config
 from guoku_crawler.article.client import RSSClient
-from guoku_crawler.celery import RequestsTask, app
-from guoku_crawler.common.image import fetch_image
+from guoku_crawler.article.dedup import filter_new, mark_seen
+from guoku_crawler.celery import RequestsTask, app, dispatch
+from guoku_crawler.common.image import image_fetcher
+from guoku_crawler.common.image_source import image_sources
+from guoku_crawler.common.rewrite import find_image_sources
+from guoku_crawler.common.rewrite import rewrite_images
 from guoku_crawler.db import session
 from guoku_crawler.models import CoreArticle
 from guoku_crawler.models import CoreAuthorizedUserProfile as Profile
@@ -31,41 +34,49 @@ def crawl_rss_list(authorized_user_id, page=1):
     }
 
     go_next = True
-    response = rss_client.get(blog_address,
-                              params=params
-                              )
+    response = rss_client.get_feed(blog_address, params=params)
+    if response is None:
+        logger.info('feed page %d of %s not changed; skip', page,
+                    blog_address)
+        return
+
     xml_content = BeautifulSoup(response.utf8_content, 'xml')
     item_list = xml_content.find_all('item')
-    for item in item_list:
-        identity_code = md5(item.link.text).hexdigest()
-        try:
-            article = session.query(CoreArticle).filter_by(
-                identity_code=identity_code,
-            ).one()
-            go_next = False
-            logger.info('some items on the page already exists in db; '
-                         'no need to go to next page')
-        except NoResultFound:
-            article = CoreArticle(
-                creator=authorized_user.user,
-                identity_code=identity_code,
-                title=item.title.text,
-                content=item.encoded.string,
-                updated_datetime=datetime.datetime.now(),
-                created_datetime=parser.parse(item.pubDate.text),
-                publish=CoreArticle.published,
-                cover=config.DEFAULT_ARTICLE_COVER
-            )
-            session.add(article)
-            session.commit()
-            crawl_rss_images.delay(article.content, article.id)
-
-        logger.info('article %s finished.', article.id)
+    new_items, existing = filter_new(
+        authorized_user.user_id, item_list,
+        lambda item: md5(item.link.text).hexdigest())
+    if existing:
+        go_next = False
+        logger.info('some items on the page already exists in db; '
+                     'no need to go to next page')
+    articles = []
+    for item in new_items:
+        article = CoreArticle(
+            creator=authorized_user.user,
+            identity_code=md5(item.link.text).hexdigest(),
+            title=item.title.text,
+            content=item.encoded.string,
+            updated_datetime=datetime.datetime.now(),
+            created_datetime=parser.parse(item.pubDate.text),
+            publish=CoreArticle.published,
+            cover=config.DEFAULT_ARTICLE_COVER
+        )
+        session.add(article)
+        articles.append(article)
+    # read what the image tasks need before commit expires the rows
+    session.flush()
+    children = [(article.content, article.id) for article in articles]
+    identity_codes = [article.identity_code for article in articles]
+    session.commit()
+    mark_seen(authorized_user.user_id, identity_codes)
+    dispatch(crawl_rss_images, children)
+    logger.info('articles %s finished.', [child[1] for child in children])
 
     if len(item_list) < 10:
         go_next = False
         logger.info('current page is the last page; will not go next page')
 
+    rss_client.remember_feed(response)
     page += 1
     if go_next:
         logger.info('prepare to get next page: %d', page)
@@ -74,27 +85,27 @@ def crawl_rss_list(authorized_user_id, page=1):
 
 
 @app.task(base=RequestsTask, name='rss.crawl_rss_images')
-def crawl_rss_images(content_string, article_id):
+def crawl_rss_images(content_string, article_id, fetch=True):
+    """
+    Point the images of the article at stored copies. Images left to the
+    images queue are picked up by running it again, with `fetch` off, once
+    they are stored.
+    """
     if not content_string:
         return
     article = session.query(CoreArticle).get(article_id)
-    article_soup = BeautifulSoup(content_string)
-    image_tags = article_soup.find_all('img')
-    if image_tags:
-        for i, image_tag in enumerate(image_tags):
-            img_src = (
-                image_tag.attrs.get('src') or image_tag.attrs.get('data-src')
-            )
-            if img_src:
-                logger.info('fetch_image for article %d: %s', article.id,
-                             img_src)
-                gk_img_rc = fetch_image(img_src, rss_client, full=False)
-                if gk_img_rc:
-                    full_path = "%s%s" % (image_host, gk_img_rc)
-                    image_tag['src'] = full_path
-                    image_tag['data-src'] = full_path
-                    if i == 0:
-                        article.cover = full_path
-            content_html = article_soup.decode_contents(formatter="html")
-            article.content = content_html
-            session.commit()
+    sources = find_image_sources(content_string)
+    if fetch:
+        paths = image_fetcher.fetch(
+            sources, rss_client, article.id,
+            callback=crawl_rss_images.si(content_string, article_id,
+                                         fetch=False))
+    else:
+        paths = image_sources.get_many(source for source in sources
+                                       if source)
+    urls = dict((source, "%s%s" % (image_host, path))
+                for source, path in paths.items())
+    if sources and sources[0] in urls:
+        article.cover = urls[sources[0]]
+    article.content = rewrite_images(content_string, urls)
+    session.commit()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+from sqlalchemy import func
+
+from guoku_crawler.db import session, r
+from guoku_crawler.models import CoreArticle
+from guoku_crawler.models import CoreAuthorizedUserProfile as Profile
+
+
+WATERMARK_PREFIX = 'weixin.watermark.'
+
+# KEYS: watermark. ARGV: timestamp. Only ever moves the watermark forward.
+ADVANCE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]))
+local timestamp = tonumber(ARGV[1])
+if not current or timestamp > current then
+    redis.call('SET', KEYS[1], ARGV[1])
+    return ARGV[1]
+end
+return tostring(current)
+"""
+
+
+class Watermark(object):
+    """
+    Publish time of the newest article crawled for each author, so a list
+    run only dispatches what is newer. Kept in redis; when the key is gone it
+    is rebuilt from the newest article of the author in `core_article`.
+    """
+
+    def __init__(self, redis_client=r):
+        self.redis = redis_client
+        self.advance_script = redis_client.register_script(ADVANCE_SCRIPT)
+
+    @staticmethod
+    def get_key(authorized_user_id):
+        return '%s%s' % (WATERMARK_PREFIX, authorized_user_id)
+
+    def get(self, authorized_user_id):
+        """
+        Returns a unix timestamp, 0 for an author with no articles yet.
+        """
+        watermark = self.redis.get(self.get_key(authorized_user_id))
+        if watermark is not None:
+            return float(watermark)
+        return self.load(authorized_user_id)
+
+    def load(self, authorized_user_id):
+        # created_datetime only has the day, so this errs on the side of
+        # dispatching articles of that day again
+        latest = session.query(func.max(CoreArticle.created_datetime)).join(
+            Profile, Profile.user_id == CoreArticle.creator_id
+        ).filter(Profile.id == authorized_user_id).scalar()
+        if latest is None:
+            return 0
+        return self.advance(authorized_user_id,
+                            time.mktime(latest.timetuple()))
+
+    def advance(self, authorized_user_id, timestamp):
+        return float(self.advance_script(
+            keys=[self.get_key(authorized_user_id)], args=[timestamp]))
+
+    def reset(self, authorized_user_id):
+        self.redis.delete(self.get_key(authorized_user_id))
+
+
+weixin_watermark = Watermark()
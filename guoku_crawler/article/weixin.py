@@ -3,12 +3,9 @@
 
 import re
 import random
-import requests
-import json
 
 from datetime import datetime
 from urlparse import urljoin
-from bs4 import BeautifulSoup
 from celery import current_task
 from pymysql.err import InternalError, DatabaseError
 
@@ -17,12 +14,22 @@ from sqlalchemy import and_
 from sqlalchemy.orm.exc import NoResultFound
 
 from guoku_crawler import config
-from guoku_crawler.article.client import WeiXinClient, update_sogou_cookie, get_user_profile_link
-from guoku_crawler.celery import RequestsTask, app
-from guoku_crawler.common.image import fetch_image
-from guoku_crawler.common.parse import clean_xml
+from guoku_crawler.article.client import WeiXinClient, phantom_get
+from guoku_crawler.article.client import schedule_cookie_refresh
+from guoku_crawler.article.cookies import cookie_pool
+from guoku_crawler.article.dedup import filter_new, mark_seen
+from guoku_crawler.article.profile_links import profile_links
+from guoku_crawler.article.watermark import weixin_watermark
+from guoku_crawler.celery import RequestsTask, app, dispatch
+from guoku_crawler.common.image import fetch_image, image_fetcher
+from guoku_crawler.common.image_source import image_sources
+from guoku_crawler.common.parse import clean_xml, extract_msg_list
+from guoku_crawler.common.parse import extract_weixin_article
+from guoku_crawler.common.rewrite import find_image_sources
+from guoku_crawler.common.rewrite import rewrite_images
 from guoku_crawler.db import session, r
-from guoku_crawler.exceptions import TooManyRequests, Expired
+from guoku_crawler.exceptions import TooManyRequests, Expired, Retry
+from guoku_crawler.exceptions import CircuitOpen
 from guoku_crawler.models import CoreArticle
 from guoku_crawler.models import CoreAuthorizedUserProfile as Profile
 
@@ -40,6 +47,8 @@ image_host = getattr(config, 'IMAGE_HOST', None)
 def crawl_weixin_list(authorized_user_id, page=1, update_cookie=False):
     authorized_user = session.query(Profile).get(authorized_user_id)
     logger.info('start crawl_weixin_list %s, authorized_user_id: %d' % (authorized_user.weixin_id, authorized_user_id))
+    # check a cookie out of the pool; the client sends it with every request
+    weixin_client.refresh_cookies(update_cookie)
     try:
         open_id, sg_cookie, user_link= get_sogou_tokens(
             weixin_id=authorized_user.weixin_id,
@@ -51,17 +60,17 @@ def crawl_weixin_list(authorized_user_id, page=1, update_cookie=False):
         logger.warning("crawl_weixin_list: too many requests or request expired. %s", e.message)
         weixin_client.refresh_cookies(update_cookie)
         # raise current_task.retry(exc=e)
-        raise TooManyRequests
+        raise Retry(message=e.message)
 
     # if not open_id:
     #     logger.warning("skip user %s: cannot find open_id. "
     #                    "Is weixin_id correct?",
     #                    authorized_user.weixin_id)
     #     return
-    if not authorized_user.weixin_openid:
-        # save open_id if it's not set already
-        authorized_user.weixin_openid = open_id
-        session.commit()
+    if not user_link:
+        logger.warning('skip user %s: cannot find profile link.',
+                       authorized_user.weixin_id)
+        return
 
     # go_next = True
     # jsonp_callback = 'sogou.weixin_gzhcb'
@@ -77,43 +86,35 @@ def crawl_weixin_list(authorized_user_id, page=1, update_cookie=False):
     #                              jsonp_callback=jsonp_callback,
     #                              headers={'Cookie': sg_cookie})
 
-    new_response = weixin_client.get(user_link, headers={'Cookie': sg_cookie})
-    new_response.utf8_content = new_response.utf8_content.replace('&quot;', '').replace('amp;', '')
-    new_response = BeautifulSoup(new_response.utf8_content, 'lxml')
-
-    scripts = new_response.find_all('script', type='text/javascript')[-1]
-    test = BeautifulSoup(scripts.text, 'xml')
-
-    # ha = re.split('content_url:\\\\\\\\', new_response.utf8_content)
-    items = re.split('title:', scripts.text)
-
-    # l = scripts.text.split(';\r\n')
-    # jsonValue = '{%s}' % (l[3].split('{', 1)[1].rsplit('}', 1)[0],)
-    # jsonValue = jsonValue.replace('&quot;', '')
-    # r = re.split('app_msg_ext_info:', jsonValue)
-    # for i in r:
-    #     o = re.split('content_url:', i)
-    #     for x in o:
-    #         print x
-    article_list = []
-    # t = re.split('content_url:\\\\\\\\', jsonValue)
-    for item in items[1:]:
-            item = item.replace('\\', '')
-            try:
-                cover = re.findall(r'cover:(.*(wx_fmt=(jpeg|png))),(subtype|author)', item)[0][0]
-            except:
-                cover = ''
-            fileid = re.findall(r'fileid:(\d+)', item)[0]
-            # title = re.findall(r'(.*),digest', item)[0]
-            article_url = u'http://mp.weixin.qq.com' + re.findall(r'content_url:(.*),source_url', item)[0]
-            article_list.append((cover, article_url, fileid))
     try:
-        for article in article_list:
-            try:
-                crawl_weixin_article.delay(article, authorized_user_id, sg_cookie)
-            except Exception as e:
-                logger.error(e)
-                logger.error('crawl_weixin_list: article %s failed' % article[1])
+        new_response = weixin_client.get(user_link)
+    except TooManyRequests as e:
+        # check_response quarantined the cookie; retry with another one
+        raise Retry(message=e.message)
+    except Expired as e:
+        # the only place a cached profile link is dropped
+        profile_links.invalidate(authorized_user.weixin_id)
+        raise Retry(countdown=5, message=e.message)
+    watermark = weixin_watermark.get(authorized_user_id)
+    article_list = [article for article in
+                    extract_msg_list(new_response.content)
+                    if article.datetime > watermark]
+    # the watermark moves past the articles of this page only once all of
+    # them are crawled, so a failed or retried one is listed again
+    newest = max([article.datetime for article in article_list] or [0])
+    article_list, existing = filter_new(authorized_user.user_id, article_list,
+                                        lambda article: article.fileid)
+    logger.info('crawl_weixin_list: %d new articles for %s, %d already '
+                'crawled', len(article_list), authorized_user.weixin_id,
+                existing)
+    if not article_list:
+        if newest:
+            weixin_watermark.advance(authorized_user_id, newest)
+        return
+    try:
+        dispatch(crawl_weixin_article,
+                 [(article, authorized_user_id) for article in article_list],
+                 callback=advance_watermark.si(authorized_user_id, newest))
     except Exception as e:
         logger.info(str(authorized_user_id) + 'failed')
         logger.error(e)
@@ -179,22 +180,25 @@ def crawl_weixin_list(authorized_user_id, page=1, update_cookie=False):
     #     crawl_weixin_list.delay(authorized_user_id=authorized_user.id,
     #                             page=page)
 @app.task(base=RequestsTask, name='weixin.crawl_weixin_article')
-def crawl_weixin_article(article_info, authorized_user_id, cookie):
+def crawl_weixin_article(article_info, authorized_user_id, cookie=None):
+    # `cookie` is only set by calls queued before the cookie pool
+    headers = {'Cookie': cookie} if cookie else None
     try:
-        resp = weixin_client.get(
-            url=article_info[1], headers={'Cookie': cookie})
-    except:
-        pass
-    article_soup = BeautifulSoup(resp.utf8_content, from_encoding='utf8',
-                                 isHTML=True)
+        resp = weixin_client.get(url=article_info[1], headers=headers)
+    except (TooManyRequests, Expired) as e:
+        # retried like any other fetch error, so the chord still completes
+        raise Retry(message=e.message)
+    page = extract_weixin_article(resp.content)
+    if None in page:
+        logger.warning('crawl_weixin_article: %s is not an article page',
+                       article_info[1])
+        return
 
     authorized_user = session.query(Profile).get(authorized_user_id)
     identity_code = article_info[2]
     creator = authorized_user.user
-    title = article_soup.select('h2.rich_media_title')[0].text
-    content = article_soup.find('div', id='js_content')
-    published_time = article_soup.select('em#post-date')[0].text
-    published_time = datetime.strptime(published_time, '%Y-%m-%d')
+    title = page.title
+    published_time = datetime.strptime(page.published, '%Y-%m-%d')
     cover = article_info[0]
     if not cover:
         # cover = article_soup.select('img#js_cover.rich_media_thumb')
@@ -209,12 +213,17 @@ def crawl_weixin_article(article_info, authorized_user_id, cookie):
             creator_id=creator.id
         ).one()
         logger.info('this article alreadey in the database.')
+        mark_seen(creator.id, [identity_code])
+        if crawl_weixin_article.request.retries:
+            # images turned away by the throttle last time; the ones stored
+            # then are known and not fetched again
+            crawl_image(article)
     except NoResultFound:
         article = CoreArticle(
             creator=creator,
             identity_code=identity_code,
             title=title,
-            content=content.decode_contents(formatter="html"),
+            content=page.content,
             created_datetime=published_time,
             updated_datetime=datetime.now(),
             publish=CoreArticle.published,
@@ -224,8 +233,11 @@ def crawl_weixin_article(article_info, authorized_user_id, cookie):
         session.commit()
         logger.info("created article id: %s. title: %s. identity_code: %s",
                     article.id, title, identity_code)
+        mark_seen(creator.id, [identity_code])
         try:
             crawl_image(article)
+        except Retry:
+            raise
         except Exception  as e:
             logger.error(e)
         # logger.info('-'*100)
@@ -257,36 +269,33 @@ def crawl_weixin_article(article_info, authorized_user_id, cookie):
         # logger.info('article %s finished.', article.id)
         # logger.info('-' * 120)
 
-def crawl_image(article):
-    cover = fetch_image(article.cover, weixin_client)
-    if cover:
-        article.cover = cover
-        session.commit()
-
-    article_soup = BeautifulSoup(article.content)
-    image_tags = article_soup.find_all('img')
-    if image_tags:
-        for i, image_tag in enumerate(image_tags):
-            img_src = (
-                image_tag.attrs.get('src') or image_tag.attrs.get('data-src')
-            )
-            if img_src:
-                logger.info('fetch_image for article %d: %s', article.id,
-                            img_src)
-                gk_img_rc = fetch_image(img_src, weixin_client, full=False)
-                if gk_img_rc:
-                    full_path = "%s%s" % (image_host, gk_img_rc)
-                    image_tag['src'] = full_path
-                    image_tag['data-src'] = full_path
-                    if not cover and not article.cover and i == 0:
-                        article.cover = gk_img_rc
-            content_html = article_soup.decode_contents(formatter="html")
-            article.content = content_html
-            session.commit()
+def crawl_image(article, fetch=True):
+    sources = find_image_sources(article.content)
+    wanted = [source for source in [article.cover] + sources if source]
+    if fetch:
+        paths = image_fetcher.fetch(
+            wanted, weixin_client, article.id,
+            callback=crawl_weixin_images.si(article.id, fetch=False))
+    else:
+        paths = image_sources.get_many(wanted)
+    if article.cover in paths:
+        article.cover = "%s%s" % (image_host, paths[article.cover])
+    elif not article.cover and sources and sources[0] in paths:
+        article.cover = paths[sources[0]]
+    article.content = rewrite_images(article.content, dict(
+        (source, "%s%s" % (image_host, path))
+        for source, path in paths.items()))
+    session.commit()
     logger.info('article %s finished.', article.id)
     logger.info('-' * 120)
 
 
+@app.task(base=RequestsTask, name='weixin.crawl_weixin_images')
+def crawl_weixin_images(article_id, fetch=True):
+    # the callback of the images left to the images queue, with `fetch` off
+    crawl_image(session.query(CoreArticle).get(article_id), fetch)
+
+
 # @app.task(base=RequestsTask, name='weixin.crawl_weixin_article')
 # def crawl_weixin_article(article_link, authorized_user_id, article_data,
 #                          sg_cookie,
@@ -386,6 +395,11 @@ def crawl_image(article):
 #     logger.info('-' * 120)
 
 
+@app.task(name='weixin.advance_watermark')
+def advance_watermark(authorized_user_id, timestamp):
+    weixin_watermark.advance(authorized_user_id, timestamp)
+
+
 def get_sogou_tokens(weixin_id, update_cookie=False):
 
     weixin_id = weixin_id.strip()
@@ -407,11 +421,14 @@ def get_sogou_tokens(weixin_id, update_cookie=False):
 
     # logger.info('get_sogou_tokens: request headers cookie: %s' % sg_cookie)
     try:
-        response = get_user_profile_link(weixin_id)
-        user_link = json.loads(response.content).get('user_link')
-        return '', '', user_link
+        open_id, user_link = profile_links.get_or_fetch(weixin_id)
+        return open_id, '', user_link
+    except Retry:
+        # an open circuit or a throttled phantom server; try again later
+        raise
     except Exception as e:
         logger.error(e)
+        return None, '', None
 
     # response = weixin_client.get(url=SEARCH_API,
     #                              params=params,
@@ -472,17 +489,71 @@ def get_qr_code(authorized_user_id, qr_code_url):
         session.commit()
 
 
+@app.task(base=RequestsTask, name='weixin.prewarm_profile_links')
+def prewarm_profile_links():
+    weixin_ids = [weixin_id for (weixin_id,) in session.query(
+        Profile.weixin_id).filter(Profile.weixin_id.isnot(None),
+                                  Profile.rss_url.is_(None))]
+    warmed = profile_links.prewarm(weixin_ids)
+    logger.info('prewarm_profile_links: %d of %d profile links warmed'
+                % (warmed, len(weixin_ids)))
+    return warmed
+
+
 @app.task(base=RequestsTask, name='weixin.prepare_sogou_cookies')
 def prepare_sogou_cookies():
     logger.info('start to prepare cookies for all the users')
+    refresh_sogou_cookies(force=True)
+
+
+def get_due_users(ages, lifetime):
+    """
+    Users whose cookie should be renewed, those without a cookie first, then
+    the oldest ones.
+    """
+    renew_at = lifetime * config.SOGOU_COOKIE_RENEW_AT
+    missing = [user for user, age in ages.items() if age is None]
+    expiring = sorted((user for user, age in ages.items()
+                       if age is not None and age >= renew_at),
+                      key=lambda user: ages[user], reverse=True)
+    return missing + expiring
+
+
+@app.task(base=RequestsTask, name='weixin.refresh_sogou_cookies')
+def refresh_sogou_cookies(force=False):
+    """
+    Renew sogou cookies before they go bad, spread over time so the phantom
+    server never sees a burst of logins. With `force` every cookie is
+    renewed, still one every `config.PHANTOM_COOKIE_SPACING` seconds.
+    """
     check_url = urljoin(config.PHANTOM_SERVER, '_health')
-    resp = requests.get(check_url)
-    ready = resp.status_code == 200
-    if ready:
-        emails = config.SOGOU_USERS
-        for sg_email in emails:
-            update_sogou_cookie.delay(sg_user=sg_email)
-            logger.info('prepare_sogou_cookie: call update_sogou_cookie.delay for user: %s' % sg_email)
-            # result.get()
-    else:
+    try:
+        resp = phantom_get(check_url)
+    except CircuitOpen:
+        # the next run checks again
+        logger.error("phantom web server is unavailable, circuit open!")
+        return
+    if resp.status_code != 200:
         logger.error("phantom web server is unavailable!")
+        return
+
+    users = list(config.SOGOU_USERS)
+    if force:
+        due = users
+    else:
+        lifetime = cookie_pool.get_lifetime()
+        due = get_due_users(cookie_pool.get_ages(users), lifetime)
+        # only as many as fit before the next run at the given spacing
+        limit = max(1, config.SOGOU_COOKIE_REFRESH_INTERVAL //
+                    config.PHANTOM_COOKIE_SPACING)
+        due = due[:limit]
+
+    scheduled = 0
+    for sg_user in due:
+        countdown = schedule_cookie_refresh(sg_user)
+        if countdown is None:
+            continue
+        scheduled += 1
+        logger.info('refresh_sogou_cookies: renew cookie of %s in %ss'
+                    % (sg_user, countdown))
+    return scheduled
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Record real crawler traffic to a cassette file and look it up again.
+
+A cassette is a json-lines file, one recorded response per line. Recording
+is switched on by setting `config.CASSETTE_RECORD_PATH`.
+"""
+
+import os
+import json
+import base64
+import threading
+
+from io import BytesIO
+from urllib import urlencode
+from urlparse import urlparse, parse_qsl, urlunparse
+
+from guoku_crawler import config
+
+
+_lock = threading.Lock()
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Location')
+
+
+def normalize_url(url):
+    parts = urlparse(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunparse((parts.scheme, parts.netloc.lower(), parts.path,
+                       parts.params, query, ''))
+
+
+def record_response(resp, *args, **kwargs):
+    """
+    requests response hook writing `resp` to the cassette. Streamed bodies
+    are read here and put back as an in-memory stream.
+    """
+    path = config.CASSETTE_RECORD_PATH
+    if not path:
+        return resp
+    body = resp.content
+    resp.raw = BytesIO(body)
+    entry = {
+        'method': resp.request.method,
+        'url': normalize_url(resp.request.url),
+        'status': resp.status_code,
+        'headers': dict((k, resp.headers[k]) for k in RECORDED_HEADERS
+                        if k in resp.headers),
+        'body': base64.b64encode(body),
+        'elapsed': resp.elapsed.total_seconds(),
+    }
+    with _lock:
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    return resp
+
+
+def get_hooks():
+    if config.CASSETTE_RECORD_PATH:
+        return {'response': [record_response]}
+    return {}
+
+
+class Cassette(object):
+    """
+    Recorded responses, looked up by method and url. A url that was not
+    recorded falls back to a response recorded for the same host and path,
+    since article and profile links carry volatile signature parameters.
+    """
+
+    def __init__(self, path=None):
+        self.by_url = {}
+        self.by_path = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        self.add(json.loads(line))
+
+    def __len__(self):
+        return len(self.by_url)
+
+    def add(self, entry):
+        entry['body'] = base64.b64decode(entry['body'])
+        url = normalize_url(entry['url'])
+        parts = urlparse(url)
+        self.by_url.setdefault((entry['method'], url), entry)
+        self.by_path.setdefault(
+            (entry['method'], parts.netloc, parts.path), []).append(entry)
+
+    def find(self, method, url):
+        url = normalize_url(url)
+        entry = self.by_url.get((method, url))
+        if entry is None:
+            parts = urlparse(url)
+            candidates = self.by_path.get((method, parts.netloc, parts.path))
+            if candidates:
+                entry = candidates[0]
+        return entry
+
+    def entries(self, host=None, path_prefix=''):
+        for (method, url), entry in self.by_url.items():
+            parts = urlparse(url)
+            if host and parts.netloc != host:
+                continue
+            if parts.path.startswith(path_prefix):
+                yield entry
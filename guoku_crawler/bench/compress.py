@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bytes saved and CPU spent by the encoding policy of
+guoku_crawler.common.compress, against storing images the way the crawler
+used to (as downloaded, PNGs converted at ImageMagick's default quality).
+Runs on the image files of a directory, the images of a cassette, or
+synthetic PNGs when neither is given:
+
+    python -m guoku_crawler.bench.compress --images samples/
+    python -m guoku_crawler.bench.compress --cassette rec.jsonl
+"""
+
+import os
+import argparse
+import resource
+
+from wand.image import Image as WandImage
+
+from guoku_crawler import config
+from guoku_crawler.bench.cassette import Cassette
+from guoku_crawler.common.compress import compress
+from guoku_crawler.common.image import KEPT_FORMATS
+from guoku_crawler.common.sniff import get_image_format
+
+
+IMAGE_HOSTS = config.IMAGE_SOURCE_WEIXIN_HOSTS
+
+
+def load_directory(path):
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), 'rb') as f:
+            yield name, f.read()
+
+
+def load_cassette(path):
+    cassette = Cassette(path)
+    for host in IMAGE_HOSTS:
+        for entry in cassette.entries(host=host):
+            if entry['status'] == 200:
+                yield entry['url'], entry['body']
+
+
+def make_images(count, size):
+    from guoku_crawler.bench.corpus import make_png
+
+    for seed in range(1, count + 1):
+        yield 'synthetic-%d.png' % seed, make_png(seed, size)
+
+
+def get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def legacy_size(data, image_format):
+    if image_format != 'png':
+        return len(data)
+    with WandImage(blob=data) as img:
+        return len(img.make_blob(format='jpeg'))
+
+
+def policy_size(data, image_format):
+    """
+    Returns (bytes stored, cpu seconds, quality or None when the original
+    is kept).
+    """
+    if image_format in KEPT_FORMATS and (
+            image_format == 'gif' or
+            len(data) <= config.IMAGE_RECOMPRESS_MIN_BYTES):
+        return len(data), 0.0, None
+    start = get_cpu_time()
+    with WandImage(blob=data) as img:
+        blob, _, quality = compress(img)
+    seconds = get_cpu_time() - start
+    if image_format in KEPT_FORMATS and len(blob) >= len(data):
+        return len(data), seconds, None
+    return len(blob), seconds, quality
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--images', default='')
+    parser.add_argument('--cassette', default='')
+    parser.add_argument('--count', type=int, default=20,
+                        help='synthetic images')
+    parser.add_argument('--size', type=int, default=800,
+                        help='side of the synthetic images')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.images:
+        images = load_directory(args.images)
+    elif args.cassette:
+        images = load_cassette(args.cassette)
+    else:
+        images = make_images(args.count, args.size)
+
+    count = encoded = 0
+    original_bytes = legacy_bytes = policy_bytes = 0
+    seconds = 0.0
+    for name, data in images:
+        image_format = get_image_format(data[:12])
+        if image_format is None:
+            continue
+        old = legacy_size(data, image_format)
+        new, cpu, quality = policy_size(data, image_format)
+        count += 1
+        original_bytes += len(data)
+        legacy_bytes += old
+        policy_bytes += new
+        seconds += cpu
+        if quality is not None:
+            encoded += 1
+        if args.verbose:
+            print '%-40s %-5s %9d -> %9d bytes (legacy %9d) q=%s %.1f ms' % (
+                name[-40:], image_format, len(data), new, old, quality,
+                cpu * 1000)
+    if not count:
+        parser.error('no images')
+
+    print '%d images, %d re-encoded as %s' % (count, encoded,
+                                               config.IMAGE_OUTPUT_FORMAT)
+    print 'downloaded %12d bytes' % original_bytes
+    print 'legacy     %12d bytes' % legacy_bytes
+    print 'policy     %12d bytes, %.1f%% less than legacy' % (
+        policy_bytes, 100.0 * (legacy_bytes - policy_bytes) / legacy_bytes)
+    print 'cpu        %12.1f ms per image, %.1f ms per re-encoded image' % (
+        seconds * 1000 / count, seconds * 1000 / max(encoded, 1))
+
+
+if __name__ == '__main__':
+    main()
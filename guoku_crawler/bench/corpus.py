@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic cassette of N authors x M articles x K images, shaped like the
+Sogou/WeChat pages the crawler sees in production.
+"""
+
+import json
+import zlib
+import base64
+import struct
+import datetime
+
+from collections import OrderedDict
+from urllib import urlencode
+
+from guoku_crawler.bench.cassette import normalize_url
+
+
+PROFILE_URL = 'http://mp.weixin.qq.com/profile'
+ARTICLE_URL = 'http://mp.weixin.qq.com/s'
+IMAGE_URL = 'http://mmbiz.qpic.cn/mmbiz_png/%s/0?wx_fmt=png'
+
+PROFILE_PAGE = u"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(name)s</title></head>
+<body>
+<div class="profile_info"><strong class="profile_nickname">%(name)s</strong></div>
+<div id="history"></div>
+<script type="text/javascript">
+    var name = "%(name)s";
+    var biz = "%(biz)s";
+</script>
+<script type="text/javascript">
+    var msgList = '%(msg_list)s';
+    seajs.use("sougou/profile.js");
+</script>
+</body></html>"""
+
+ARTICLE_PAGE = u"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title>
+<script type="text/javascript">%(filler_script)s</script>
+</head>
+<body id="activity-detail" class="zh_CN">
+<div id="js_article" class="rich_media">
+<div class="rich_media_inner">
+<h2 class="rich_media_title" id="activity-name">%(title)s</h2>
+<div class="rich_media_meta_list">
+<em id="post-date" class="rich_media_meta rich_media_meta_text">%(date)s</em>
+<a class="rich_media_meta rich_media_meta_link rich_media_meta_nickname" href="javascript:void(0);" id="post-user">%(name)s</a>
+</div>
+<div class="rich_media_content " id="js_content">
+%(body)s
+</div>
+</div>
+</div>
+<script type="text/javascript">
+    var biz = "%(biz)s" || "";
+    var appuin = "%(biz)s" || "";
+    %(filler_script)s
+</script>
+</body></html>"""
+
+
+def make_png(seed, size=128):
+    """
+    A `size` x `size` RGB png whose pixels depend on `seed`, so every image
+    of the corpus has its own md5.
+    """
+    rows = []
+    for y in range(size):
+        row = bytearray([0])
+        for x in range(size):
+            row.extend(((x + seed) & 255, (y + (seed >> 8)) & 255,
+                        (x * y + (seed >> 16)) & 255))
+        rows.append(bytes(row))
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I',
+                                                                       crc)
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(b''.join(rows))) +
+            chunk(b'IEND', b''))
+
+
+def get_weixin_id(author):
+    return 'bench%d' % author
+
+
+def get_article_url(author, article):
+    return '%s?%s' % (ARTICLE_URL, urlencode([('__biz', get_weixin_id(author)),
+                                              ('mid', article),
+                                              ('idx', 1)]))
+
+
+def get_image_url(author, article, image):
+    return IMAGE_URL % ('%d_%d_%d' % (author, article, image))
+
+
+def make_msg_list(author, articles, today):
+    items = []
+    for article in range(articles):
+        published = today - datetime.timedelta(days=article)
+        timestamp = int((published - datetime.datetime(1970, 1, 1))
+                        .total_seconds())
+        fileid = author * 100000 + article + 1
+        content_url = get_article_url(author, article).replace(
+            'http://mp.weixin.qq.com', '')
+        items.append(OrderedDict([
+            ('comm_msg_info', OrderedDict([
+                ('id', fileid), ('type', 49), ('datetime', timestamp),
+                ('fakeid', str(author)), ('status', 2), ('content', ''),
+            ])),
+            ('app_msg_ext_info', OrderedDict([
+                ('title', u'文章 %d-%d' % (author, article)),
+                ('digest', u'摘要'),
+                ('content_url', content_url),
+                ('source_url', ''),
+                ('cover', get_image_url(author, article, 0)),
+                ('subtype', 9),
+                ('is_multi', 0),
+                ('multi_app_msg_item_list', []),
+                ('author', ''),
+                ('copyright_stat', 100),
+                ('duration', 0),
+                ('del_flag', 1),
+                ('fileid', fileid),
+            ])),
+        ]))
+    msg_list = json.dumps({'list': items}, ensure_ascii=False,
+                          separators=(',', ':'))
+    # the page embeds it html-escaped, with escaped slashes, in a js string
+    return (msg_list.replace('/', '\\/').replace('&', '&amp;')
+            .replace('"', '&quot;'))
+
+
+def make_article_page(author, article, images, today, filler_kb):
+    # text with entities, straight inside the content div
+    body = [u'5 &lt;script&gt;alert(1)&lt;/script&gt; &amp; 7 &gt; 6']
+    for image in range(images):
+        body.append(u'<p>段落 %d</p>' % image * 5)
+        body.append(u'<p><img data-src="%s" data-type="png" '
+                    u'data-ratio="1" data-w="128" style="width: auto;"></p>' %
+                    get_image_url(author, article, image).replace('&',
+                                                                  '&amp;'))
+    published = today - datetime.timedelta(days=article)
+    return ARTICLE_PAGE % {
+        'title': u'文章 %d-%d' % (author, article),
+        'name': get_weixin_id(author),
+        'biz': get_weixin_id(author),
+        'date': published.strftime('%Y-%m-%d'),
+        'body': u'\n'.join(body),
+        'filler_script': u'var filler = "%s";' % (u'x' * 1024 * filler_kb),
+    }
+
+
+def entry(method, url, body, content_type, status=200):
+    return {
+        'method': method,
+        'url': normalize_url(url),
+        'status': status,
+        'headers': {'Content-Type': content_type},
+        'body': base64.b64encode(body),
+        'elapsed': 0,
+    }
+
+
+def make_cassette(path, phantom_server, authors, articles, images,
+                  filler_kb=64, image_size=128):
+    today = datetime.datetime.combine(datetime.date.today(),
+                                      datetime.time(8))
+    html = 'text/html; charset=utf-8'
+    with open(path, 'w') as f:
+        for author in range(authors):
+            weixin_id = get_weixin_id(author)
+            profile_link = '%s?%s' % (PROFILE_URL,
+                                      urlencode([('src', 3),
+                                                 ('biz', weixin_id)]))
+            userlink = '%suserlink?%s' % (phantom_server,
+                                          urlencode([('type', '1'),
+                                                     ('ie', 'utf8'),
+                                                     ('query', weixin_id)]))
+            page = PROFILE_PAGE % {
+                'name': weixin_id,
+                'biz': weixin_id,
+                'msg_list': make_msg_list(author, articles, today),
+            }
+            lines = [
+                entry('POST', userlink, json.dumps({'user_link': profile_link}),
+                      'application/json'),
+                entry('GET', profile_link, page.encode('utf-8'), html),
+            ]
+            for article in range(articles):
+                page = make_article_page(author, article, images, today,
+                                         filler_kb)
+                lines.append(entry('GET', get_article_url(author, article),
+                                   page.encode('utf-8'), html))
+                for image in range(images):
+                    seed = (author * articles + article) * images + image + 1
+                    lines.append(entry('GET',
+                                       get_image_url(author, article, image),
+                                       make_png(seed, image_size),
+                                       'image/png'))
+            for line in lines:
+                f.write(json.dumps(line) + '\n')
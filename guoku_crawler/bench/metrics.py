@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-stage timings of the crawl pipeline, pushed to redis so that samples
+from eager runs and from real worker processes end up in the same place.
+Installed in workers when `config.BENCH_METRICS` is set.
+"""
+
+import os
+import json
+import time
+import resource
+
+from functools import wraps
+
+from celery.signals import task_prerun, task_postrun
+
+from guoku_crawler.db import r
+
+
+SAMPLES_KEY = 'bench.samples'
+_started = {}
+
+
+def record(stage, seconds):
+    sample = {
+        'stage': stage,
+        'seconds': seconds,
+        'pid': os.getpid(),
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    r.rpush(SAMPLES_KEY, json.dumps(sample))
+
+
+def timed(stage, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(stage, time.time() - start)
+    wrapper.bench_wrapped = True
+    return wrapper
+
+
+def on_task_prerun(task_id=None, **kwargs):
+    _started[task_id] = time.time()
+
+
+def on_task_postrun(task_id=None, task=None, **kwargs):
+    start = _started.pop(task_id, None)
+    if start is not None:
+        record(task.name, time.time() - start)
+
+
+def patch(owner, name, stage):
+    func = getattr(owner, name)
+    if not getattr(func, 'bench_wrapped', False):
+        setattr(owner, name, timed(stage, func))
+
+
+def install():
+    """
+    Time every task, plus the pipeline stages that are plain functions.
+    Timings are inclusive: eager tasks include the tasks they call.
+    """
+    from guoku_crawler.article import crawler, weixin
+    from guoku_crawler.common import image
+
+    task_prerun.connect(on_task_prerun, weak=False)
+    task_postrun.connect(on_task_postrun, weak=False)
+    patch(crawler, 'crawl_user_articles', 'crawl_user_articles')
+    patch(weixin, 'crawl_image', 'crawl_image')
+    patch(image.HandleImage, 'save', 'HandleImage.save')
+    patch(image.default_storage, 'save', 'storage.save')
+
+
+def reset():
+    r.delete(SAMPLES_KEY)
+
+
+def collect():
+    return [json.loads(sample) for sample in r.lrange(SAMPLES_KEY, 0, -1)]
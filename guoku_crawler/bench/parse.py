@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of the WeChat page parsers.
+
+Times the extractors of guoku_crawler.common.parse against the
+BeautifulSoup parsing the weixin tasks used to do, and measures the peak
+memory each needs for one page, on the pages of a cassette, or of a
+synthetic corpus when no cassette is given:
+
+    python -m guoku_crawler.bench.parse --pages profile --cassette rec.jsonl
+    python -m guoku_crawler.bench.parse --pages article
+"""
+
+import os
+import re
+import timeit
+import argparse
+import tempfile
+import multiprocessing
+
+from bs4 import BeautifulSoup
+from lxml import html
+
+from guoku_crawler.bench.cassette import Cassette
+from guoku_crawler.common.parse import extract_msg_list
+from guoku_crawler.common.parse import extract_weixin_article
+
+
+PAGE_PATHS = {
+    'profile': '/profile',
+    'article': '/s',
+}
+
+
+def legacy_extract(content):
+    content = content.decode('utf-8').replace('&quot;', '').replace('amp;',
+                                                                    '')
+    soup = BeautifulSoup(content, 'lxml')
+    scripts = soup.find_all('script', type='text/javascript')[-1]
+    BeautifulSoup(scripts.text, 'xml')
+    article_list = []
+    for item in re.split('title:', scripts.text)[1:]:
+        item = item.replace('\\', '')
+        try:
+            cover = re.findall(
+                r'cover:(.*(wx_fmt=(jpeg|png))),(subtype|author)', item)[0][0]
+        except IndexError:
+            cover = ''
+        fileid = re.findall(r'fileid:(\d+)', item)[0]
+        article_url = u'http://mp.weixin.qq.com' + re.findall(
+            r'content_url:(.*),source_url', item)[0]
+        article_list.append((cover, article_url, fileid))
+    return article_list
+
+
+def legacy_extract_article(content):
+    soup = BeautifulSoup(content, 'lxml', from_encoding='utf8')
+    title = soup.select('h2.rich_media_title')[0].text
+    content = soup.find('div', id='js_content')
+    published = soup.select('em#post-date')[0].text
+    return title, published, content.decode_contents(formatter='html')
+
+
+PARSERS = {
+    'profile': (('legacy', legacy_extract),
+                ('extract_msg_list',
+                 lambda page: list(extract_msg_list(page)))),
+    'article': (('legacy', legacy_extract_article),
+                ('extract_weixin_article', extract_weixin_article)),
+}
+
+
+def get_content_text(content):
+    fragment = html.fragment_fromstring(content, create_parent='div')
+    return u' '.join(fragment.text_content().split())
+
+
+def parsers_agree(kind, old, new):
+    if kind == 'profile':
+        return len(old) == len(new)
+    # the article html is serialized differently; compare its text, which
+    # also catches escaped text coming out as markup
+    return ([text.strip() for text in old[:2]] == list(new[:2]) and
+            get_content_text(old[2]) == get_content_text(new[2]))
+
+
+def load_pages(cassette_path, kind):
+    cassette = Cassette(cassette_path)
+    return [entry['body'] for entry in
+            cassette.entries(host='mp.weixin.qq.com',
+                             path_prefix=PAGE_PATHS[kind])
+            if entry['status'] == 200 and
+            entry['url'].split('?')[0].endswith(PAGE_PATHS[kind])]
+
+
+def make_pages(kind, authors, articles, filler_kb):
+    from guoku_crawler.bench.corpus import make_cassette
+
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+    try:
+        make_cassette(path, 'http://127.0.0.1:8888/', authors, articles, 0,
+                      filler_kb=filler_kb, image_size=1)
+        return load_pages(path, kind)
+    finally:
+        os.remove(path)
+
+
+def bench(func, pages, number):
+    seconds = min(timeit.repeat(lambda: [func(page) for page in pages],
+                                repeat=3, number=number))
+    return seconds / number / len(pages)
+
+
+def read_hwm():
+    with open('/proc/self/status') as status:
+        return int(re.search(r'VmHWM:\s+(\d+)', status.read()).group(1))
+
+
+def measure_peak(func, page, queue):
+    # a forked child starts with the peak RSS of its parent; reset it to
+    # the current RSS so only the parse is counted
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+    before = read_hwm()
+    func(page)
+    queue.put(read_hwm() - before)
+
+
+def peak_memory(func, page):
+    """
+    Growth of the peak RSS, in KB, of a forked process parsing `page`.
+    Needs Linux: the peak is reset and read through /proc/self.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure_peak,
+                                      args=(func, page, queue))
+    process.start()
+    peak = queue.get()
+    process.join()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--pages', choices=sorted(PAGE_PATHS),
+                        default='profile')
+    parser.add_argument('--cassette', default='')
+    parser.add_argument('--authors', type=int, default=20)
+    parser.add_argument('--articles', type=int, default=10,
+                        help='articles per synthetic author')
+    parser.add_argument('--filler-kb', type=int, default=64,
+                        help='inline script per synthetic article page')
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.cassette:
+        pages = load_pages(args.cassette, args.pages)
+    else:
+        pages = make_pages(args.pages, args.authors, args.articles,
+                           args.filler_kb)
+    if not pages:
+        parser.error('no %s pages in %s' % (args.pages, args.cassette))
+
+    legacy, current = PARSERS[args.pages]
+    for page in pages:
+        if not parsers_agree(args.pages, legacy[1](page), current[1](page)):
+            print 'warning: parsers disagree on a page'
+
+    largest = max(pages, key=len)
+    print '%d %s pages, %d bytes on average, %d at most' % (
+        len(pages), args.pages, sum(len(page) for page in pages) / len(pages),
+        len(largest))
+    for name, func in (legacy, current):
+        print '%-24s %10.1f us/page %8d KB peak on the largest page' % (
+            name, bench(func, pages, args.number) * 1e6,
+            peak_memory(func, largest))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end crawl throughput benchmark.
+
+Runs crawl_articles -> crawl_user_articles -> weixin.crawl_list ->
+weixin.crawl_weixin_article -> crawl_image -> HandleImage.save -> storage
+for N authors x M articles against the local stand-in, either with celery
+in eager mode or with real workers over the local redis, and writes
+articles/minute, images/minute, p50/p99 per stage and peak RSS per worker
+to a json file.
+
+Needs a local redis and ImageMagick. The database defaults to a scratch
+sqlite file; never point --database at production.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import datetime
+import subprocess
+
+from collections import defaultdict
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def summarize(samples):
+    by_stage = defaultdict(list)
+    peak_rss = defaultdict(int)
+    for sample in samples:
+        by_stage[sample['stage']].append(sample['seconds'])
+        peak_rss[sample['pid']] = max(peak_rss[sample['pid']],
+                                      sample['maxrss'])
+    stages = {}
+    for stage, seconds in by_stage.items():
+        stages[stage] = {
+            'count': len(seconds),
+            'mean': sum(seconds) / len(seconds),
+            'p50': percentile(seconds, 50),
+            'p99': percentile(seconds, 99),
+        }
+    return stages, dict(peak_rss)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def get_env(args, work_dir, standin_url):
+    env = {
+        'GK_DATABASE_URI': args.database or 'sqlite:///%s' % os.path.join(
+            work_dir, 'bench.db'),
+        'GK_CONFIG_REDIS_HOST': args.redis_host,
+        'GK_BROKER_URL': 'redis://%s:6379/0' % args.redis_host,
+        'GK_CELERY_RESULT_BACKEND': 'redis://%s:6379/0' % args.redis_host,
+        'GK_PHANTOM_SERVER': standin_url,
+        'GK_LOCAL_FILE_STORAGE': 'True',
+        'GK_MEDIA_ROOT': os.path.join(work_dir, 'media'),
+        'GK_BENCH_METRICS': 'True',
+        'GK_REQUEST_INTERVAL': '0.001',
+        'GK_HOST_RATE_LIMITS': '{}',
+        'HTTP_PROXY': standin_url,
+    }
+    if args.mode == 'eager':
+        env['GK_CELERY_ALWAYS_EAGER'] = 'True'
+    return env
+
+
+def seed_authors(authors):
+    from guoku_crawler.bench.corpus import get_weixin_id
+    from guoku_crawler.db import engine, session
+    from guoku_crawler.models import Base, AuthGroup, CoreGkuser
+    from guoku_crawler.models import CoreAuthorizedUserProfile as Profile
+
+    Base.metadata.create_all(engine)
+    group = session.query(AuthGroup).filter_by(name='Author').first()
+    if group is None:
+        group = AuthGroup(name='Author')
+        session.add(group)
+    now = datetime.datetime.now()
+    for author in range(authors):
+        email = 'bench-author-%d@bench.guoku.local' % author
+        if session.query(CoreGkuser).filter_by(email=email).first():
+            continue
+        user = CoreGkuser(email=email, password='', last_login=now,
+                          is_superuser=0, is_active=1, is_admin=0,
+                          date_joined=now)
+        user.groups.append(group)
+        user.authorized_profile.append(
+            Profile(weixin_id=get_weixin_id(author)))
+        session.add(user)
+    session.commit()
+
+
+def count_articles():
+    from sqlalchemy import func
+    from guoku_crawler.db import session
+    from guoku_crawler.models import CoreArticle
+
+    session.commit()
+    return session.query(func.count(CoreArticle.id)).scalar()
+
+
+def get_annotations():
+    # crawl_articles is limited to 1/m per worker, which would pace the
+    # whole run; the other limits stay
+    from guoku_crawler import config
+
+    annotations = dict(config.CELERY_ANNOTATIONS)
+    annotations['crawl_articles'] = dict(
+        annotations.get('crawl_articles', {}), rate_limit=None)
+    return annotations
+
+
+def start_workers(args, env):
+    workers = []
+    for i in range(args.workers):
+        workers.append(subprocess.Popen(
+            [sys.executable, '-m', 'celery', '-A', 'guoku_crawler', 'worker',
+             '-l', 'warning', '-Q', 'celery,images,cookies',
+             '-c', str(args.concurrency), '-n', 'bench%d@%%h' % i],
+            env=env))
+    return workers
+
+
+def run(args, work_dir):
+    standin_url = 'http://127.0.0.1:%d/' % args.port
+    # guoku_crawler.config reads GK_* on import, so set them up front
+    os.environ.update(get_env(args, work_dir, standin_url))
+    env = dict(os.environ)
+    env['GK_CELERY_ANNOTATIONS'] = repr(get_annotations())
+
+    from guoku_crawler.bench import metrics
+    from guoku_crawler.bench.corpus import make_cassette
+
+    cassette_path = os.path.join(work_dir, 'corpus.jsonl')
+    make_cassette(cassette_path, standin_url, args.authors, args.articles,
+                  args.images)
+    standin = subprocess.Popen(
+        [sys.executable, '-m', 'guoku_crawler.bench.standin',
+         '--cassette', cassette_path, '--port', str(args.port),
+         '--latency', str(args.latency), '--error-rate', str(args.error_rate)],
+        env=env)
+    workers = []
+    try:
+        seed_authors(args.authors)
+
+        from guoku_crawler.article import crawler
+
+        metrics.reset()
+        crawler.AUTH_USER_LIST = crawler.get_auth_users()
+        if args.mode == 'workers':
+            workers = start_workers(args, env)
+        time.sleep(2)
+
+        expected = args.authors * args.articles
+        start = time.time()
+        for _ in range(args.authors):
+            crawler.crawl_articles.delay()
+        articles = count_articles()
+        while articles < expected and time.time() - start < args.timeout:
+            time.sleep(1)
+            articles = count_articles()
+        wall = time.time() - start
+    finally:
+        for process in workers + [standin]:
+            process.terminate()
+        for process in workers + [standin]:
+            process.wait()
+
+    stages, peak_rss = summarize(metrics.collect())
+    images = stages.get('HandleImage.save', {}).get('count', 0)
+    return {
+        'commit': get_commit(),
+        'date': datetime.datetime.now().isoformat(),
+        'mode': args.mode,
+        'authors': args.authors,
+        'articles_per_author': args.articles,
+        'images_per_article': args.images,
+        'latency': args.latency,
+        'error_rate': args.error_rate,
+        'wall_seconds': wall,
+        'articles': articles,
+        'images': images,
+        'articles_per_minute': articles * 60.0 / wall,
+        'images_per_minute': images * 60.0 / wall,
+        'stages': stages,
+        'peak_rss_kb': peak_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--mode', choices=('eager', 'workers'),
+                        default='eager')
+    parser.add_argument('--authors', type=int, default=10)
+    parser.add_argument('--articles', type=int, default=5)
+    parser.add_argument('--images', type=int, default=5,
+                        help='images per article')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--database', default='',
+                        help='sqlalchemy url of a scratch database')
+    parser.add_argument('--timeout', type=int, default=600)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='guoku_bench_')
+    try:
+        result = run(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print json.dumps(result, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
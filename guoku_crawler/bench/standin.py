@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for Sogou, WeChat, blogs, image CDNs and the phantom server.
+
+Replays a cassette recorded with `CASSETTE_RECORD_PATH`, with configurable
+latency and error rate. Point the crawler at it with:
+
+    HTTP_PROXY=http://127.0.0.1:8888 GK_PHANTOM_SERVER=http://127.0.0.1:8888/
+
+The phantom endpoints `/_health`, `/_sg_cookie` and `/userlink` are answered
+on any host.
+"""
+
+import json
+import random
+import argparse
+import itertools
+
+from urlparse import urlparse, parse_qs
+
+from tornado import gen, web
+from tornado.ioloop import IOLoop
+
+from guoku_crawler.bench.cassette import Cassette
+
+
+class StandIn(object):
+    def __init__(self, cassette, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        profiles = [entry['url'] for entry in
+                    cassette.entries(host='mp.weixin.qq.com',
+                                     path_prefix='/profile')]
+        self.profile_links = itertools.cycle(profiles or [''])
+        self.cookie_count = itertools.count(1)
+
+    def delay(self):
+        return max(0, random.gauss(self.latency, self.jitter))
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+    def user_link(self, weixin_id):
+        for entry in self.cassette.entries(path_prefix='/userlink'):
+            query = parse_qs(urlparse(entry['url']).query)
+            if query.get('query') == [weixin_id]:
+                return entry['body']
+        return json.dumps({'user_link': next(self.profile_links)})
+
+    def sg_cookie(self, email):
+        return json.dumps({
+            'sg_cookie': 'SUID=standin%d; SNUID=%s' % (next(self.cookie_count),
+                                                       email)
+        })
+
+
+class StandInHandler(web.RequestHandler):
+    SUPPORTED_METHODS = ('GET', 'POST', 'HEAD')
+
+    def initialize(self, standin):
+        self.standin = standin
+
+    def get_url(self):
+        # proxied requests carry the absolute url in the request line
+        if self.request.uri.startswith('http'):
+            return self.request.uri
+        return self.request.full_url()
+
+    def compute_etag(self):
+        return None
+
+    @gen.coroutine
+    def replay(self):
+        yield gen.sleep(self.standin.delay())
+        if self.standin.fails():
+            self.send_error(503)
+            return
+
+        url = self.get_url()
+        path = urlparse(url).path
+        if path == '/_health':
+            self.write('I am OK.')
+        elif path == '/_sg_cookie':
+            self.write(self.standin.sg_cookie(self.get_argument('email', '')))
+        elif path == '/userlink':
+            self.write(self.standin.user_link(self.get_argument('query', '')))
+        else:
+            entry = self.standin.cassette.find(self.request.method, url)
+            if entry is None:
+                self.send_error(404)
+                return
+            self.set_status(entry['status'])
+            for name, value in entry['headers'].items():
+                self.set_header(name, value)
+            if entry['status'] != 304:
+                self.write(entry['body'])
+
+    get = post = head = replay
+
+
+def make_app(cassette_path, latency=0.0, jitter=0.0, error_rate=0.0):
+    standin = StandIn(Cassette(cassette_path), latency, jitter, error_rate)
+    return web.Application([(r'.*', StandInHandler, {'standin': standin})])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--cassette', required=True)
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mean response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='standard deviation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 503')
+    args = parser.parse_args()
+
+    app = make_app(args.cassette, args.latency, args.jitter, args.error_rate)
+    app.listen(args.port)
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
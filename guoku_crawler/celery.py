@@ -2,9 +2,15 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
+import random
+
 from celery import Celery
 from celery import Task
+from celery import chord, group
+from celery.canvas import maybe_signature
 from guoku_crawler import config
+from guoku_crawler.common.breaker import jittered_backoff
+from guoku_crawler.exceptions import CircuitOpen, Retry, Throttled
 
 import requests
 
@@ -20,13 +26,64 @@ class RequestsTask(Task):
     compression = 'gzip'
     default_retry_delay = 45
     send_error_emails = True
-    max_retries = 1
+    max_retries = config.TASK_MAX_RETRIES
 
     def __call__(self, *args, **kwargs):
         try:
             return super(RequestsTask, self).__call__(*args, **kwargs)
         except (requests.Timeout, requests.ConnectionError) as e:
-            raise self.retry(exc=e)
+            raise self.retry(exc=e, countdown=self.backoff())
+        except CircuitOpen as e:
+            # the host is failing; come back once its circuit may close
+            raise self.retry(exc=e, countdown=e.countdown)
+        except Throttled as e:
+            # no token for the host yet; spread the retries over its refill
+            countdown = e.countdown + int(random.uniform(0, e.countdown))
+            raise self.retry(exc=e, countdown=countdown,
+                             max_retries=config.THROTTLE_MAX_RETRIES)
+        except Retry as e:
+            raise self.retry(exc=e,
+                             countdown=max(e.countdown, self.backoff()))
+
+    def backoff(self):
+        return jittered_backoff(self.request.retries)
+
+
+def get_signature(task, arguments, chunk_size, callback=None):
+    if chunk_size > 1:
+        signature = task.chunks(arguments, chunk_size).group()
+    else:
+        signature = group(task.s(*args) for args in arguments)
+    if callback is not None:
+        signature = chord(signature, callback)
+    return signature
+
+
+@app.task(name='dispatch.expand')
+def expand(task_name, arguments, chunk_size, callback=None):
+    # a group is published member by member from wherever it is applied
+    if callback is not None:
+        callback = maybe_signature(callback, app=app)
+    get_signature(app.tasks[task_name], arguments, chunk_size,
+                  callback).apply_async()
+
+
+def dispatch(task, arguments, chunk_size=None, callback=None):
+    """
+    Publish `task` once per tuple of `arguments`. The caller publishes one
+    message; a worker expands it and publishes the calls, so a list task is
+    not held up by its children. With a chunk size above 1 the calls are
+    packed that many per task; a chunk runs its calls in order in one
+    worker, and a call that fails there is not retried on its own.
+    A `callback` signature runs once every call succeeded, retries
+    included; it is not run when one of them fails for good.
+    """
+    arguments = [tuple(args) for args in arguments]
+    if not arguments:
+        return
+    return expand.delay(task.name, arguments,
+                        chunk_size or config.DISPATCH_CHUNK_SIZE, callback)
+
 
 if __name__ == '__main__':
     app.start()
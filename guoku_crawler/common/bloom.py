@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import struct
+
+from hashlib import md5
+
+from redis.exceptions import ResponseError
+
+from guoku_crawler.config import logger
+from guoku_crawler.db import r
+
+
+def get_bitset_size(capacity, error_rate):
+    """
+    Returns (bits, hashes) of a bloom filter holding `capacity` items at
+    `error_rate`.
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) /
+                         math.log(2) ** 2))
+    hashes = max(1, int(round(bits / float(capacity) * math.log(2))))
+    return bits, hashes
+
+
+def encode(item):
+    if isinstance(item, unicode):
+        return item.encode('utf-8')
+    return str(item)
+
+
+class BloomFilter(object):
+    """
+    A set that may answer "seen" for an item it has never seen, at
+    `error_rate`, but never "not seen" for one it has. Uses the RedisBloom
+    module when the server has it, otherwise a bitset in plain redis.
+    """
+
+    def __init__(self, name, capacity, error_rate, redis_client=r):
+        self.name = name
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.redis = redis_client
+        self.bits, self.hashes = get_bitset_size(capacity, error_rate)
+        self._has_module = None
+        self._reserved = set()
+
+    @property
+    def has_module(self):
+        if self._has_module is None:
+            try:
+                self.redis.execute_command('BF.EXISTS', self.name, '')
+                self._has_module = True
+            except ResponseError as e:
+                # unknown command, or a bitset already lives at the key
+                logger.info('BloomFilter(%s): using a bitset: %s',
+                            self.name, e)
+                self._has_module = False
+        return self._has_module
+
+    def get_offsets(self, item):
+        h1, h2 = struct.unpack('>QQ', md5(encode(item)).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def reserve(self, name):
+        if self.has_module:
+            try:
+                self.redis.execute_command('BF.RESERVE', name,
+                                           self.error_rate, self.capacity)
+            except ResponseError:
+                # already reserved
+                pass
+
+    def add_many(self, items, name=None):
+        name = name or self.name
+        items = [encode(item) for item in items]
+        if not items:
+            return
+        if self.has_module:
+            if name not in self._reserved:
+                self.reserve(name)
+                self._reserved.add(name)
+            self.redis.execute_command('BF.MADD', name, *items)
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for item in items:
+            for offset in self.get_offsets(item):
+                pipe.setbit(name, offset, 1)
+        pipe.execute()
+
+    def add(self, item):
+        self.add_many([item])
+
+    def contains_many(self, items):
+        """
+        Returns a list of booleans, True for items probably seen before.
+        """
+        items = [encode(item) for item in items]
+        if not items:
+            return []
+        if self.has_module:
+            return [bool(seen) for seen in self.redis.execute_command(
+                'BF.MEXISTS', self.name, *items)]
+        pipe = self.redis.pipeline(transaction=False)
+        for item in items:
+            for offset in self.get_offsets(item):
+                pipe.getbit(self.name, offset)
+        bits = pipe.execute()
+        return [all(bits[i * self.hashes:(i + 1) * self.hashes])
+                for i in range(len(items))]
+
+    def __contains__(self, item):
+        return self.contains_many([item])[0]
+
+    def rebuild(self, batches):
+        """
+        Refill the filter from `batches`, lists of items, and swap it in
+        once complete so lookups never see a half-loaded filter.
+        """
+        staging = self.name + '.rebuild'
+        self.redis.delete(staging)
+        self.reserve(staging)
+        self._reserved.add(staging)
+        count = 0
+        for batch in batches:
+            self.add_many(batch, name=staging)
+            count += len(batch)
+        if count:
+            self.redis.rename(staging, self.name)
+        else:
+            self.redis.delete(self.name)
+        if count > self.capacity:
+            logger.warning('BloomFilter(%s): %d items over a capacity of %d; '
+                           'raise it to keep the error rate', self.name,
+                           count, self.capacity)
+        return count
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+
+from redis.exceptions import RedisError
+
+from guoku_crawler import config
+from guoku_crawler.config import logger
+from guoku_crawler.db import r
+from guoku_crawler.exceptions import CircuitOpen
+from guoku_crawler.common.throttle import get_host
+
+
+def jittered_backoff(attempt, base=None, cap=None):
+    """
+    "Full jitter" exponential backoff: a random delay between 1 and
+    min(cap, base * 2 ** attempt) seconds, so a retry never comes back at
+    once.
+    """
+    if base is None:
+        base = config.RETRY_BACKOFF_BASE
+    if cap is None:
+        cap = config.RETRY_BACKOFF_MAX
+    return int(random.uniform(1, min(cap, base * 2 ** attempt)))
+
+
+# ARGV: now, probe timeout. Returns the seconds to wait before the host may
+# be tried again, "0" if the request may go ahead. Once the cool down of an
+# open circuit is over it becomes half-open and lets a single probe through.
+BREAKER_ALLOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local h = redis.call('HMGET', KEYS[1], 'state', 'opened_until', 'probe_until')
+local state = h[1] or 'closed'
+if state == 'closed' then
+    return '0'
+end
+if state == 'open' then
+    local opened_until = tonumber(h[2]) or 0
+    if now < opened_until then
+        return tostring(opened_until - now)
+    end
+    state = 'half-open'
+    redis.call('HSET', KEYS[1], 'state', state)
+else
+    local probe_until = tonumber(h[3]) or 0
+    if now < probe_until then
+        return tostring(probe_until - now)
+    end
+end
+redis.call('HSET', KEYS[1], 'probe_until', now + tonumber(ARGV[2]))
+return '0'
+"""
+
+# ARGV: now, failure threshold, failure window, cool down, max cool down,
+# jitter factor. Counts a failure and opens the circuit when the threshold
+# is reached within the window, or when a half-open probe fails. Each trip
+# doubles the cool down. Returns the cool down, "0" if still closed.
+BREAKER_FAILURE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local h = redis.call('HMGET', KEYS[1], 'state', 'failures', 'window_start',
+                     'trips')
+local state = h[1] or 'closed'
+local failures = tonumber(h[2]) or 0
+local window_start = tonumber(h[3]) or now
+local trips = tonumber(h[4]) or 0
+if now - window_start > tonumber(ARGV[3]) then
+    failures = 0
+    window_start = now
+end
+failures = failures + 1
+if state == 'half-open' or failures >= tonumber(ARGV[2]) then
+    local cooldown = math.min(tonumber(ARGV[5]),
+                              tonumber(ARGV[4]) * 2 ^ trips) * tonumber(ARGV[6])
+    redis.call('HMSET', KEYS[1], 'state', 'open',
+               'opened_until', now + cooldown, 'trips', trips + 1,
+               'failures', 0, 'window_start', now)
+    return tostring(cooldown)
+end
+redis.call('HMSET', KEYS[1], 'failures', failures,
+           'window_start', window_start)
+return '0'
+"""
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker kept in redis, shared by every worker.
+
+    closed: requests go through, failures are counted.
+    open: requests fail fast with `CircuitOpen` until the cool down is over.
+    half-open: one probe request is let through; its success closes the
+    circuit, its failure opens it again for twice as long.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, redis_client=r):
+        self.redis = redis_client
+        self.allow_script = redis_client.register_script(BREAKER_ALLOW_SCRIPT)
+        self.failure_script = redis_client.register_script(
+            BREAKER_FAILURE_SCRIPT)
+
+    @staticmethod
+    def get_key(host):
+        return 'breaker.%s' % host
+
+    def get_state(self, url):
+        state = self.redis.hget(self.get_key(get_host(url)), 'state')
+        return state or self.CLOSED
+
+    def before_request(self, url):
+        host = get_host(url)
+        try:
+            wait = float(self.allow_script(keys=[self.get_key(host)],
+                                           args=[time.time(),
+                                                 config.CIRCUIT_PROBE_TIMEOUT]))
+        except RedisError as e:
+            logger.error('circuit breaker unavailable: %s', e)
+            return
+        if wait > 0:
+            raise CircuitOpen(countdown=int(wait) + 1,
+                              message=u'circuit open for %s.' % host)
+
+    def record(self, url, resp=None):
+        """
+        Record the outcome of a request: no response or a 5xx is a failure.
+        """
+        if resp is None or resp.status_code >= 500:
+            self.record_failure(url)
+        else:
+            self.record_success(url)
+
+    def record_success(self, url):
+        try:
+            self.redis.delete(self.get_key(get_host(url)))
+        except RedisError as e:
+            logger.error('circuit breaker unavailable: %s', e)
+
+    def record_failure(self, url):
+        host = get_host(url)
+        try:
+            cooldown = float(self.failure_script(
+                keys=[self.get_key(host)],
+                args=[time.time(),
+                      config.CIRCUIT_FAILURE_THRESHOLD,
+                      config.CIRCUIT_FAILURE_WINDOW,
+                      config.CIRCUIT_COOLDOWN,
+                      config.CIRCUIT_COOLDOWN_MAX,
+                      random.uniform(0.8, 1.2)]))
+        except RedisError as e:
+            logger.error('circuit breaker unavailable: %s', e)
+            return
+        if cooldown:
+            logger.warning('circuit for %s opened for %ds', host, cooldown)
+
+
+default_breaker = CircuitBreaker()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+How re-encoded images are written: metadata stripped, progressive JPEG
+(or WebP where IMAGE_OUTPUT_FORMAT asks for it and ImageMagick can write
+it), at the lowest quality that still looks like the source to
+IMAGE_TARGET_SSIM, and within IMAGE_MAX_BYTES when that is set.
+
+Benchmark the policy on sample images with:
+
+    python -m guoku_crawler.bench.compress --images DIR
+"""
+
+import os
+
+from wand.api import library
+from wand.image import Image as WandImage
+
+from guoku_crawler import config
+from guoku_crawler.config import logger
+
+
+EXTENSIONS = {
+    'jpeg': 'jpg',
+    'webp': 'webp',
+}
+CONTENT_TYPES = {
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+# InterlaceType of MagickCore; plane interlacing is progressive for jpeg
+PLANE_INTERLACE = 3
+# SSIM is measured on grayscale thumbnails this many pixels across
+SSIM_SIDE = 128
+SSIM_BLOCK = 8
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+_output_format = None
+
+
+def get_output_format():
+    """
+    IMAGE_OUTPUT_FORMAT, or jpeg when ImageMagick has no encoder for it.
+    """
+    global _output_format
+    if _output_format is None:
+        _output_format = config.IMAGE_OUTPUT_FORMAT
+        if _output_format != 'jpeg':
+            try:
+                with WandImage(width=1, height=1) as probe:
+                    probe.make_blob(format=_output_format)
+            except Exception as e:
+                logger.warning('cannot write %s, writing jpeg: %s',
+                               _output_format, e)
+                _output_format = 'jpeg'
+    return _output_format
+
+
+def get_content_type(file_name):
+    """
+    The content type of an image this module encoded, by its extension.
+    """
+    ext_name = os.path.splitext(file_name)[1][1:]
+    for output_format, extension in EXTENSIONS.items():
+        if extension == ext_name:
+            return CONTENT_TYPES[output_format]
+
+
+def get_gray(img):
+    with img.clone() as gray:
+        gray.transform(resize='%dx%d>' % (SSIM_SIDE, SSIM_SIDE))
+        gray.depth = 8
+        return gray.width, gray.height, bytearray(
+            gray.make_blob(format='gray'))
+
+
+def get_ssim(reference, blob):
+    """
+    Mean SSIM of the grayscale thumbnails of `reference`, a (width, height,
+    pixels) of get_gray, and of the image encoded in `blob`, over
+    SSIM_BLOCK square windows.
+    """
+    width, height, x = reference
+    with WandImage(blob=blob) as img:
+        _, _, y = get_gray(img)
+    n = float(SSIM_BLOCK * SSIM_BLOCK)
+    total, blocks = 0.0, 0
+    for top in range(0, height - SSIM_BLOCK + 1, SSIM_BLOCK):
+        for left in range(0, width - SSIM_BLOCK + 1, SSIM_BLOCK):
+            sx = sy = sxx = syy = sxy = 0
+            for row in range(top, top + SSIM_BLOCK):
+                start = row * width + left
+                for i in range(start, start + SSIM_BLOCK):
+                    a, b = x[i], y[i]
+                    sx += a
+                    sy += b
+                    sxx += a * a
+                    syy += b * b
+                    sxy += a * b
+            mx, my = sx / n, sy / n
+            vx, vy = sxx / n - mx * mx, syy / n - my * my
+            cov = sxy / n - mx * my
+            total += (((2 * mx * my + SSIM_C1) * (2 * cov + SSIM_C2)) /
+                      ((mx * mx + my * my + SSIM_C1) * (vx + vy + SSIM_C2)))
+            blocks += 1
+    # thumbnails smaller than a block compare as identical
+    return total / blocks if blocks else 1.0
+
+
+def encode(img, output_format, quality):
+    with img.clone() as copy:
+        copy.strip()
+        copy.compression_quality = quality
+        if output_format == 'jpeg':
+            library.MagickSetInterlaceScheme(copy.wand, PLANE_INTERLACE)
+        return copy.make_blob(format=output_format)
+
+
+def search(predicate, low, high):
+    # the lowest value of [low, high] for which `predicate` holds, high + 1
+    # when it holds for none; `predicate` only turns from False to True
+    high += 1
+    while low < high:
+        middle = (low + high) // 2
+        if predicate(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def compress(img):
+    """
+    Encode the decoded `img` by the policy of this module. Returns (blob,
+    output format, quality). The orientation in the metadata is applied to
+    `img` first, since stripping drops it.
+    """
+    img.auto_orient()
+    output_format = get_output_format()
+    low, high = config.IMAGE_QUALITY_RANGE
+    blobs = {}
+
+    def get_blob(quality):
+        if quality not in blobs:
+            blobs[quality] = encode(img, output_format, quality)
+        return blobs[quality]
+
+    quality = high
+    if config.IMAGE_TARGET_SSIM:
+        reference = get_gray(img)
+        quality = min(high, search(
+            lambda q: get_ssim(reference, get_blob(q)) >=
+            config.IMAGE_TARGET_SSIM, low, high))
+    if config.IMAGE_MAX_BYTES and len(get_blob(quality)) > \
+            config.IMAGE_MAX_BYTES:
+        # the highest quality within budget, or the lowest allowed
+        quality = max(low, search(
+            lambda q: len(get_blob(q)) > config.IMAGE_MAX_BYTES,
+            low, quality) - 1)
+    return get_blob(quality), output_format, quality
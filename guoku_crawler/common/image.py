@@ -1,18 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import logging
+import threading
 
+from uuid import uuid4
 from hashlib import md5
+from StringIO import StringIO
+from collections import namedtuple
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import inspect
 from wand.exceptions import WandException
 from wand.image import Image as WandImage
 
 from guoku_crawler import config
+from guoku_crawler.celery import RequestsTask, app, dispatch
 from guoku_crawler.db import session
 from guoku_crawler.models import CoreMedia
+from guoku_crawler.common.compress import CONTENT_TYPES
+from guoku_crawler.common.compress import EXTENSIONS as OUTPUT_EXTENSIONS
+from guoku_crawler.common.compress import compress, get_content_type
+from guoku_crawler.common.compress import get_output_format
 from guoku_crawler.common.file import ContentFile
+from guoku_crawler.common.storage.file import File
+from guoku_crawler.common.image_source import image_sources
+from guoku_crawler.common.phash import get_dhash, perceptual_index
+from guoku_crawler.common.sniff import EXTENSIONS, sniff
 from guoku_crawler.common.storage.storage import FileSystemStorage
 from guoku_crawler.common.storage.storage import MogileFSStorage
+from guoku_crawler.common.throttle import get_host
+from guoku_crawler.exceptions import ImageRejected, Retry
 
 
 image_path = getattr(config, 'MOGILEFS_MEDIA_URL', 'images/')
@@ -24,94 +43,337 @@ def get_storage_class():
         return FileSystemStorage()
     return MogileFSStorage()
 default_storage = get_storage_class()
+# the mogilefs client keeps one tracker connection; images are stored from
+# several threads at once
+storage_lock = threading.Lock()
+
+
+# formats stored as they are unless large; the others are always encoded
+KEPT_FORMATS = ('jpeg', 'webp', 'gif')
+
+# content_type is None unless the image was re-encoded, dhash and size (the
+# decoded width, height) None unless it was decoded, and media_id set when it
+# resolved to a near-duplicate
+StoredImage = namedtuple('StoredImage', ('file_name', 'content_type',
+                                         'derivatives', 'dhash', 'size',
+                                         'media_id'))
+# an image left to the images queue, staged in storage under staged_name
+PendingImage = namedtuple('PendingImage', ('staged_name', 'ext_name'))
 
 
 class HandleImage(object):
+    """
+    An image spooled from `image_file` once, in memory up to
+    IMAGE_SPOOL_MAX_SIZE and on disk beyond, and hashed as it streams in.
+    Its format and dimensions are sniffed from the first bytes, and
+    ImageRejected raised as soon as they rule it out. It is only decoded
+    when it has to be converted, cropped or compressed.
+    Close it, or use it as a context manager, to free the spool and the
+    decoded image.
+    """
     path = image_path
 
-    def __init__(self, image_file):
-        self.content_type = self.get_content_type(image_file)
-        self._name = None
-        if hasattr(image_file, 'chunks'):
-            self._image_data = ''.join(chuck for chuck in image_file.chunks())
-        else:
-            self._image_data = image_file.read()
-        self.ext_name = self.get_ext_name()
-        image_file.close()
-        logging.info('init HandleImage obj.')
+    def __init__(self, image_file, ext_name=None):
+        self._img = None
+        self._blob = None
+        self.format = self.width = self.height = None
+        self.output_content_type = None
+        self.dhash = self.dhash_size = None
+        self._file = SpooledTemporaryFile(max_size=config.IMAGE_SPOOL_MAX_SIZE)
+        digest = md5()
+        head = ''
         try:
-            self.img = WandImage(blob=self._image_data)
-        except BaseException as e:
-            logging.error(e)
-            self.img = WandImage(file=image_file)
+            for chunk in self.iter_chunks(image_file):
+                if head is not None:
+                    head += chunk
+                    if self.sniff(head):
+                        head = None
+                digest.update(chunk)
+                self._file.write(chunk)
+                if self._file.tell() > config.IMAGE_MAX_DOWNLOAD:
+                    raise ImageRejected('over %d bytes' %
+                                        config.IMAGE_MAX_DOWNLOAD)
+            if head is not None:
+                self.sniff(head, complete=True)
+        except Exception:
+            self._file.close()
+            raise
+        finally:
+            image_file.close()
+        self._name = digest.hexdigest()
+        self.size = self._file.tell()
+        self.content_type = 'image/%s' % self.format
+        self.ext_name = ext_name or EXTENSIONS[self.format]
+        logging.info('init HandleImage obj.')
+
+    @staticmethod
+    def iter_chunks(image_file):
+        if hasattr(image_file, 'chunks'):
+            for chunk in image_file.chunks():
+                yield chunk
+            return
+        # a small first read, to turn the image down before the rest
+        chunk = image_file.read(config.IMAGE_SNIFF_BYTES)
+        while chunk:
+            yield chunk
+            chunk = image_file.read(File.DEFAULT_CHUNK_SIZE)
+
+    def sniff(self, head, complete=False):
+        """
+        Check the format and dimensions of the image starting with `head`.
+        Returns whether that is settled; raises ImageRejected if it is not
+        an image, is a tracker or spacer, or is too large.
+        """
+        if len(head) < 12 and not complete:
+            return False
+        image_format, width, height = sniff(head)
+        if image_format is None:
+            raise ImageRejected('not an image')
+        if width is None and not (complete or
+                                  len(head) >= config.IMAGE_SNIFF_MAX_BYTES):
+            return False
+        self.format, self.width, self.height = image_format, width, height
+        if width is None:
+            return True
+        if min(width, height) < config.IMAGE_MIN_SIDE:
+            raise ImageRejected('%dx%d %s' % (width, height, image_format))
+        if width * height > config.IMAGE_MAX_PIXELS:
+            raise ImageRejected('%dx%d pixels' % (width, height))
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._img is not None:
+            self._img.close()
+            self._img = None
+        self._blob = None
+        self._file.close()
 
     @property
-    def image_data(self):
-        return self._image_data
+    def img(self):
+        if self._img is None:
+            self._file.seek(0)
+            self._img = WandImage(file=self._file)
+        return self._img
 
     @property
     def name(self):
-        self._name = md5(self.image_data).hexdigest()
         return self._name
 
-    @staticmethod
-    def get_content_type(image_file):
-        try:
-            content_type = image_file.content_type
-        except AttributeError:
-            content_type = None
-        if content_type is None:
-            return None
-
-        if content_type == 'image/png':
-            content_type = 'image/jpeg'
-        return content_type
-
-    def get_ext_name(self):
-        ext = 'jpg'
-        try:
-            ext = self.content_type.split('/')[1]
-        except Exception as e:
-            logging.error(e)
-            pass
+    def set_blob(self, blob):
+        # the image was re-encoded; name it after what gets stored
+        self._blob = blob
+        self._name = md5(blob).hexdigest()
 
-        return ext
+    def get_content(self):
+        if self._blob is not None:
+            return ContentFile(self._blob)
+        return self.open_spool()
+
+    def open_spool(self):
+        """
+        A handle of its own on the spooled image: mogilefs closes the file
+        it stores, and the spool is still needed for the derivatives.
+        """
+        self._file.seek(0)
+        if self._file._rolled:
+            self._file.flush()
+            return File(os.fdopen(os.dup(self._file.fileno()), 'rb'))
+        return File(StringIO(self._file.read()))
 
     def crop_square(self):
-        _img = WandImage(blob=self._image_data)
+        _img = self.img
         _delta = _img.width - _img.height
         if _delta > 0:
             _img.crop(_delta / 2, 0, width=_img.height, height=_img.height)
         elif _delta < 0:
             _img.crop(0, -_delta / 2, width=_img.width, height=_img.width)
 
-        self._image_data = _img.make_blob()
+    def needs_compress(self):
+        if self.format in KEPT_FORMATS:
+            return (self.format != 'gif' and
+                    self.size > config.IMAGE_RECOMPRESS_MIN_BYTES)
+        return True
 
-    def save(self, path='', square=False):
-        if self.ext_name == 'png':
-            self._image_data = self.img.make_blob(format='jpeg')
-            self.ext_name = 'jpg'
+    def needs_decode(self, square=False):
+        return (self.ext_name == 'png' or (square and self.ext_name == 'jpg')
+                or self.needs_compress())
 
-        if square and (self.ext_name == 'jpg'):
-            self.crop_square()
+    def reencode(self, force):
+        """
+        Encode the decoded image by the policy of common.compress, unless
+        nothing but size asks for it (`force` is false) and the original
+        is smaller.
+        """
+        blob, output_format, quality = compress(self.img)
+        if not force and len(blob) >= self.size:
+            return
+        logging.info('encoded %s at quality %d: %d -> %d bytes',
+                     output_format, quality, self.size, len(blob))
+        self.ext_name = OUTPUT_EXTENSIONS[output_format]
+        self.output_content_type = CONTENT_TYPES[output_format]
+        self.set_blob(blob)
+
+    def save(self, path='', square=False):
+        """
+        Store the image and return its name.
+        """
+        if self.needs_decode(square):
+            square = square and self.ext_name in ('jpg', 'png')
+            if square:
+                self.crop_square()
+            self.reencode(force=square or self.ext_name == 'png' or
+                          self.format not in KEPT_FORMATS)
 
         if path:
             self.path = path
 
         file_name = self.path + self.name + '.' + self.ext_name
-        if not default_storage.exists(file_name=file_name):
-            # try:
-            file_name = default_storage.save(file_name,
-                                             ContentFile(self.image_data))
-            # except Exception as e:
-            #     logging.info(e)
-        else:
-            pass
-
+        store_files([(file_name, self.get_content())])
         return file_name
 
+    def save_with_derivatives(self, path='', square=False, executor=None):
+        """
+        Store the image and its derivatives from one decode, and return a
+        StoredImage. When the image is decoded anyway, one that looks like a
+        stored image resolves to it instead. With the 'celery' executor an
+        image that has to be converted or cropped is only staged in storage,
+        and a PendingImage returned for transcode; one that only needs its
+        derivatives is resized here.
+        """
+        executor = executor or config.IMAGE_EXECUTOR
+        if executor == 'celery' and self.needs_decode(square):
+            return self.stage()
+        decode = self.needs_decode(square) or self.has_derivatives()
+        if decode and not (path or square):
+            duplicate = self.find_duplicate()
+            if duplicate:
+                media_id, file_name = duplicate
+                logging.info('%s looks like %s', self.name, file_name)
+                return StoredImage(file_name, None, [], self.dhash,
+                                   self.dhash_size, media_id)
+        file_name = self.save(path, square)
+        return StoredImage(file_name, self.output_content_type,
+                           self.save_derivatives(file_name), self.dhash,
+                           self.dhash_size, None)
 
-def fetch_image(image_url, client, full=True):
+    def find_duplicate(self):
+        # the size rules out crops and other shapes of the same picture,
+        # which hash alike
+        self.dhash = get_dhash(self.img)
+        self.dhash_size = self.img.width, self.img.height
+        return perceptual_index.find(self.dhash, self.dhash_size)
+
+    def has_derivatives(self):
+        # animated images are stored as they are
+        return bool(config.IMAGE_DERIVATIVES) and self.format != 'gif'
+
+    @staticmethod
+    def get_derivative_name(file_name, suffix):
+        dir_name, base_name = os.path.split(file_name)
+        return '%s/%s/%s.%s' % (dir_name, suffix,
+                                os.path.splitext(base_name)[0],
+                                OUTPUT_EXTENSIONS[get_output_format()])
+
+    def save_derivatives(self, file_name):
+        """
+        Resize clones of the decoded image to the sizes of
+        IMAGE_DERIVATIVES, named after the stored `file_name`, and store the
+        ones missing in one batch. Sizes larger than the image are skipped.
+        """
+        if not self.has_derivatives():
+            return []
+        names = [(self.get_derivative_name(file_name, suffix), width, square)
+                 for suffix, width, square in config.IMAGE_DERIVATIVES]
+        with storage_lock:
+            names = [name for name in names if not is_stored(name[0])]
+        if not names:
+            return []
+
+        img = self.img
+        files = []
+        for name, width, square in names:
+            if width >= (min(img.width, img.height) if square else img.width):
+                continue
+            with img.clone() as derivative:
+                if square:
+                    side = min(img.width, img.height)
+                    derivative.crop((img.width - side) / 2,
+                                    (img.height - side) / 2,
+                                    width=side, height=side)
+                    derivative.resize(width, width)
+                else:
+                    derivative.resize(width,
+                                      max(1, img.height * width / img.width))
+                files.append((name, ContentFile(compress(derivative)[0])))
+        return store_files(files)
+
+    def stage(self):
+        # a name of its own, so no other transcode removes it
+        staged_name = '%s%s.%s' % (config.IMAGE_STAGING_PATH, uuid4().hex,
+                                   self.ext_name)
+        with storage_lock:
+            staged_name = default_storage.save(staged_name, self.open_spool())
+        return PendingImage(staged_name, self.ext_name)
+
+
+def is_stored(file_name):
+    # the caller holds storage_lock; mogilefs answers from the storage index
+    return default_storage.exists(file_name=file_name)
+
+
+def store_files(files):
+    """
+    Store the (name, content) pairs not stored yet, holding the storage
+    once for all of them. Returns the names stored.
+    """
+    stored = []
+    with storage_lock:
+        for file_name, content in files:
+            if not is_stored(file_name):
+                stored.append(default_storage.save(file_name, content))
+    return stored
+
+
+@app.task(base=RequestsTask, name='image.transcode')
+def transcode(image_url, staged_name, ext_name):
+    """
+    Store the image staged under `staged_name` and its derivatives the way
+    store_image does, record it as fetched from `image_url` and remove the
+    staged copy. Returns the stored name, None if the image cannot be
+    handled.
+    """
+    try:
+        with HandleImage(default_storage.open(staged_name),
+                         ext_name=ext_name) as image:
+            stored = image.save_with_derivatives(executor='inline')
+            stored = stored._replace(
+                content_type=stored.content_type or image.content_type)
+    except ImageRejected as e:
+        logging.info('image %s rejected: %s', image_url, e.message)
+        return
+    except (AttributeError, WandException) as e:
+        logging.error('handle image(%s) Error: %s', image_url, e.message)
+        return
+    finally:
+        with storage_lock:
+            default_storage.delete(staged_name)
+    record_images({image_url: stored})
+    return stored.file_name
+
+
+def store_image(image_url, client, executor=None):
+    """
+    Download and store an image and its derivatives. Returns a
+    StoredImage, a PendingImage if it is left to the images queue, or None
+    if the url is skipped or the image cannot be handled. Touches no
+    database, so it can run in any thread.
+    """
     logging.info('fetch_image %s', image_url)
     if not image_url:
         logging.info('empty image url; skip')
@@ -121,18 +383,166 @@ def fetch_image(image_url, client, full=True):
         return
     r = client.get(url=image_url, stream=True)
     try:
-        try:
-            content_type = r.headers['Content-Type']
-        except KeyError:
-            content_type = 'image/jpeg'
-        image = HandleImage(r.raw)
-        image_name = image.save()
-        media = CoreMedia(file_path=image_name, content_type=content_type)
-        session.add(media)
-        session.commit()
-        if full:
-            return "%s%s" % (image_host, image_name)
-        return image_name
+        if int(r.headers.get('Content-Length') or 0) > \
+                config.IMAGE_MAX_DOWNLOAD:
+            r.close()
+            raise ImageRejected('Content-Length %s' %
+                                r.headers['Content-Length'])
+        with HandleImage(r.raw) as image:
+            stored = image.save_with_derivatives(executor=executor)
+            if isinstance(stored, PendingImage):
+                return stored
+            return stored._replace(
+                content_type=stored.content_type or image.content_type)
 
+    except ImageRejected as e:
+        logging.info('image %s rejected: %s', image_url, e.message)
     except (AttributeError, WandException) as e:
         logging.error('handle image(%s) Error: %s', image_url, e.message)
+
+
+def get_media(stored):
+    # the core_media row of a near-duplicate, else a new one
+    if stored.media_id:
+        media = session.query(CoreMedia).get(stored.media_id)
+        if media is not None:
+            return media
+    return CoreMedia(file_path=stored.file_name,
+                     content_type=stored.content_type)
+
+
+def get_derivative_medias(derivatives):
+    return [CoreMedia(file_path=name, content_type=get_content_type(name))
+            for name in derivatives]
+
+
+def record_images(stored_images):
+    """
+    Add the media rows of `stored_images`, a dict of source url ->
+    StoredImage, in one commit and index their hashes.
+    """
+    medias = {}
+    rows = []
+    for source, stored in stored_images.items():
+        medias[source] = get_media(stored)
+        rows.extend(get_derivative_medias(stored.derivatives))
+    image_sources.add(medias, rows)
+    index_medias([(stored, medias[source])
+                  for source, stored in stored_images.items()])
+
+
+def index_medias(stored_medias):
+    """
+    Index the hashes of the (StoredImage, CoreMedia) pairs newly committed.
+    """
+    perceptual_index.add_many(
+        (stored.dhash, stored.size, inspect(media).identity[0],
+         stored.file_name)
+        for stored, media in stored_medias
+        if stored.dhash is not None and not stored.media_id and
+        inspect(media).identity)
+
+
+def fetch_image(image_url, client, full=True):
+    image_name = image_sources.get_many([image_url]).get(image_url)
+    if not image_name:
+        stored = store_image(image_url, client, executor='inline')
+        if not stored:
+            return
+        image_name = stored.file_name
+        record_images({image_url: stored})
+    if full:
+        return "%s%s" % (image_host, image_name)
+    return image_name
+
+
+class ImageFetcher(object):
+    """
+    Fetches the images of an article in a pool of `workers` threads, at
+    most `per_host` at a time from any one CDN. Politeness between requests
+    to a host is still up to the client's throttle.
+    """
+
+    def __init__(self, workers=None, per_host=None):
+        self.workers = workers or config.IMAGE_FETCH_WORKERS
+        self.per_host = per_host or config.IMAGE_FETCH_PER_HOST
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def get_semaphore(self, url):
+        host = get_host(url)
+        with self._lock:
+            if host not in self._semaphores:
+                limit = config.IMAGE_FETCH_HOST_LIMITS.get(host,
+                                                           self.per_host)
+                self._semaphores[host] = threading.BoundedSemaphore(limit)
+            return self._semaphores[host]
+
+    def store(self, image_url, client, executor):
+        with self.get_semaphore(image_url):
+            return store_image(image_url, client, executor)
+
+    def fetch(self, sources, client, article_id=None, callback=None):
+        """
+        Store every distinct image of `sources` and return a dict of source
+        url to the path it was stored at, leaving out the ones that failed.
+        Images stored before are not downloaded again; the media rows of the
+        others are added from the calling thread in one commit. Failed
+        images keep their source url; the error is only raised when none
+        could be fetched. An image turned away by the throttle or an open
+        circuit raises `Retry` once the others are recorded, so the task
+        comes back for it and finds the rest known.
+
+        With a `callback` signature, images that have to be decoded are
+        left out and handed to the images queue by IMAGE_EXECUTOR; the
+        callback runs once they are recorded, to pick up their paths.
+        """
+        sources = set(source for source in sources if source)
+        known = image_sources.get_many(sources)
+        sources = [source for source in sources if source not in known]
+        logging.info('fetch %d images for article %s, %d known',
+                     len(sources), article_id, len(known))
+        if not sources:
+            return known
+        executor = 'inline' if callback is None else None
+        with ThreadPoolExecutor(min(self.workers, len(sources))) as pool:
+            futures = [(source, pool.submit(self.store, source, client,
+                                            executor))
+                       for source in sources]
+
+        stored_images = {}
+        pending = []
+        error = retry = None
+        for source, future in futures:
+            try:
+                stored = future.result()
+            except Retry as e:
+                logging.warning('fetch_image %s deferred: %s', source,
+                                e.message)
+                if retry is None or e.countdown > retry.countdown:
+                    retry = e
+                continue
+            except Exception as e:
+                logging.error('fetch_image %s failed: %s', source, e)
+                error = error or e
+                continue
+            if isinstance(stored, PendingImage):
+                pending.append((source,) + stored)
+            elif stored:
+                stored_images[source] = stored
+        record_images(stored_images)
+        if pending:
+            logging.info('transcode %d images for article %s',
+                         len(pending), article_id)
+            dispatch(transcode, pending, callback=callback)
+        if retry is not None:
+            raise retry
+        if error is not None and not (stored_images or pending or known):
+            raise error
+        paths = dict((source, stored.file_name)
+                     for source, stored in stored_images.items())
+        paths.update(known)
+        return paths
+
+
+image_fetcher = ImageFetcher()
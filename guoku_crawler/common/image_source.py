@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Source url -> stored file of the images already fetched, so images reused
+across posts (banners, QR codes, footers) are not downloaded again. Kept in
+redis and backed by the crawler_image_source table, which this creates:
+
+    python -m guoku_crawler.common.image_source
+"""
+
+from hashlib import md5
+from urllib import urlencode
+from urlparse import urlparse, urlunparse, parse_qsl
+
+from sqlalchemy.exc import IntegrityError
+
+from guoku_crawler import config
+from guoku_crawler.config import logger
+from guoku_crawler.db import engine, session, r
+from guoku_crawler.models import CoreMedia, CrawlerImageSource
+
+
+SOURCES_KEY = 'image.source'
+
+
+def normalize_source_url(url):
+    """
+    The same image is linked with different formatting and tracking
+    parameters; drop those, and the scheme of WeChat CDN urls. Returns a
+    utf-8 str.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    parts = urlparse(url.strip())
+    host = parts.netloc.lower()
+    scheme = parts.scheme.lower()
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k not in config.IMAGE_SOURCE_NOISE_PARAMS and
+             not k.startswith('utm_')]
+    if host in config.IMAGE_SOURCE_WEIXIN_HOSTS:
+        scheme = 'http'
+        query = [(k, v) for k, v in query
+                 if k not in config.IMAGE_SOURCE_WEIXIN_PARAMS]
+    return urlunparse((scheme, host, parts.path, parts.params,
+                       urlencode(sorted(query)), ''))
+
+
+def get_source_hash(url):
+    return md5(normalize_source_url(url)).hexdigest()
+
+
+class ImageSourceCache(object):
+
+    def __init__(self, redis_client=r):
+        self.redis = redis_client
+
+    def get_many(self, urls):
+        """
+        Returns a dict of url -> stored file path for the urls already
+        fetched: from redis, then in one query for the rest.
+        """
+        hashes = dict((url, get_source_hash(url)) for url in set(urls))
+        if not hashes:
+            return {}
+        urls = list(hashes)
+        paths = dict((url, path) for url, path in
+                     zip(urls, self.redis.hmget(
+                         SOURCES_KEY, [hashes[url] for url in urls]))
+                     if path)
+
+        missing = dict((hashes[url], url) for url in urls
+                       if url not in paths)
+        if missing:
+            rows = session.query(CrawlerImageSource.source_hash,
+                                 CoreMedia.file_path).join(
+                CoreMedia, CoreMedia.id == CrawlerImageSource.media_id
+            ).filter(CrawlerImageSource.source_hash.in_(missing)).all()
+            found = dict(rows)
+            if found:
+                self.redis.hmset(SOURCES_KEY, found)
+            for source_hash, path in found.items():
+                paths[missing[source_hash]] = path
+        return paths
+
+    def get_recorded(self, source_hashes):
+        rows = session.query(CrawlerImageSource.source_hash).filter(
+            CrawlerImageSource.source_hash.in_(source_hashes)).all()
+        return set(source_hash for (source_hash,) in rows)
+
+    def add(self, medias, rows=()):
+        """
+        Record `medias`, a dict of source url -> CoreMedia not yet committed,
+        and commit them with `rows`. Sources already recorded, by another
+        worker say, keep their media; the others are recorded.
+        """
+        if not medias:
+            return
+        sources = {}
+        for url, media in medias.items():
+            # several spellings of a url map to the first one's media
+            sources.setdefault(get_source_hash(url), (url, media))
+        paths = dict((source_hash, media.file_path)
+                     for source_hash, (_, media) in sources.items())
+        for _ in range(2):
+            recorded = self.get_recorded(sources)
+            session.add_all(rows)
+            session.add_all(medias.values())
+            for source_hash, (url, media) in sources.items():
+                if source_hash not in recorded:
+                    session.add(CrawlerImageSource(source_hash=source_hash,
+                                                   source_url=url[:1024],
+                                                   media=media))
+            try:
+                session.commit()
+            except IntegrityError as e:
+                # recorded meanwhile; look again which ones
+                logger.warning('ImageSourceCache().add: %s', e)
+                session.rollback()
+                continue
+            new = dict((source_hash, path)
+                       for source_hash, path in paths.items()
+                       if source_hash not in recorded)
+            if new:
+                self.redis.hmset(SOURCES_KEY, new)
+            return
+        session.add_all(rows)
+        session.add_all(medias.values())
+        session.commit()
+
+
+image_sources = ImageSourceCache()
+
+
+if __name__ == '__main__':
+    CrawlerImageSource.__table__.create(engine, checkfirst=True)
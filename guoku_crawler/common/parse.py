@@ -1,7 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
+import cgi
+import json
+
+from io import BytesIO
+from collections import namedtuple
+from datetime import datetime
+
 from bs4 import BeautifulSoup
+from lxml import etree
+
+
+WEIXIN_HOST = 'http://mp.weixin.qq.com'
+# quotes inside the json are html-escaped, so the js string ends at the
+# first single quote
+MSG_LIST_PATTERN = re.compile(r"msgList\s*=\s*'([^']*)'")
+# what crawl_weixin_article reads off an article page, by element
+ARTICLE_TARGETS = {
+    'title': lambda el: (el.tag == 'h2' and
+                         'rich_media_title' in el.get('class', '').split()),
+    'published': lambda el: el.tag == 'em' and el.get('id') == 'post-date',
+    'content': lambda el: el.tag == 'div' and el.get('id') == 'js_content',
+}
+# &amp; goes last so that escaped entities come out as text
+ENTITIES = (('&quot;', '"'), ('&#39;', "'"), ('&lt;', '<'), ('&gt;', '>'),
+            ('&amp;', '&'))
 
 
 def parse_article_link(result_json):
@@ -30,3 +55,115 @@ def clean_xml(xml_str):
         xml_str = xml_str.replace(from_str, to_str)
 
     return xml_str
+
+
+class WeixinMessage(namedtuple('WeixinMessage', ['cover', 'content_url',
+                                                 'fileid', 'title',
+                                                 'datetime'])):
+    """
+    An article of a sogou profile page. `fileid` is the identity code of the
+    article, `datetime` its publish time as a unix timestamp.
+    """
+    __slots__ = ()
+
+    @property
+    def published(self):
+        return datetime.fromtimestamp(self.datetime)
+
+
+def unescape_entities(s):
+    if '&' not in s:
+        return s
+    for entity, char in ENTITIES:
+        s = s.replace(entity, char)
+    return s
+
+
+def absolute_url(url):
+    if url.startswith('/'):
+        return WEIXIN_HOST + url
+    return url
+
+
+def make_weixin_message(info, timestamp):
+    return WeixinMessage(
+        cover=unescape_entities(info.get('cover') or u''),
+        content_url=absolute_url(unescape_entities(info['content_url'])),
+        fileid=unicode(info.get('fileid', u'')),
+        title=unescape_entities(info.get('title') or u''),
+        datetime=timestamp,
+    )
+
+
+def extract_msg_list(content):
+    """
+    Yield a WeixinMessage for every article in the `msgList` of a sogou
+    profile page, multi-article messages included, straight from the raw
+    page without building a DOM.
+    """
+    match = MSG_LIST_PATTERN.search(content, max(0, content.find('msgList')))
+    if not match:
+        return
+    msg_list = json.loads(unescape_entities(match.group(1)))
+    for msg in msg_list.get('list', ()):
+        timestamp = msg.get('comm_msg_info', {}).get('datetime', 0)
+        info = msg.get('app_msg_ext_info')
+        if not info:
+            continue
+        for item in [info] + info.get('multi_app_msg_item_list', []):
+            if item.get('content_url'):
+                yield make_weixin_message(item, timestamp)
+
+
+WeixinArticle = namedtuple('WeixinArticle', ['title', 'published',
+                                             'content'])
+
+
+def get_inner_html(element):
+    # the text is unescaped by the parser; children serialize escaped
+    return cgi.escape(element.text or u'') + u''.join(
+        etree.tostring(child, encoding=unicode, method='html')
+        for child in element)
+
+
+def get_text(element):
+    return u''.join(element.itertext()).strip()
+
+
+def extract_weixin_article(content):
+    """
+    Returns a WeixinArticle with the title, the post date text and the
+    inner html of `div#js_content` of a WeChat article page, None for
+    whatever the page lacks. Everything outside those three elements is
+    dropped as soon as it is parsed, and parsing stops once all three are
+    found, so the trailing scripts are never read.
+    """
+    found = {}
+    target = None
+    events = etree.iterparse(BytesIO(content), events=('start', 'end'),
+                             html=True, encoding='utf-8', huge_tree=True,
+                             remove_comments=True)
+    for event, element in events:
+        if target is None and event == 'start':
+            for name, matches in ARTICLE_TARGETS.items():
+                if name not in found and matches(element):
+                    target = name, element
+                    break
+        elif event == 'end':
+            if target is not None:
+                if element is not target[1]:
+                    continue
+                name = target[0]
+                if name == 'content':
+                    found[name] = get_inner_html(element)
+                else:
+                    found[name] = get_text(element)
+                target = None
+                if len(found) == len(ARTICLE_TARGETS):
+                    break
+            element.clear()
+            parent = element.getparent()
+            while parent is not None and element.getprevious() is not None:
+                del parent[0]
+    return WeixinArticle(found.get('title'), found.get('published'),
+                         found.get('content'))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Difference hashes of stored images, indexed for near-duplicate lookups.
+
+The 64 bit hash is split into PHASH_CHUNKS chunks, each kept in a redis
+set per value (multi-index hashing). Two hashes within
+IMAGE_DHASH_DISTANCE < PHASH_CHUNKS bits of each other share at least one
+chunk exactly, so the candidates of a lookup are the members of the
+hash's own buckets, checked for the full distance. A dHash is blind to
+the shape of the image, so a candidate also has to have the same aspect
+ratio, to IMAGE_DHASH_ASPECT_TOLERANCE.
+"""
+
+from guoku_crawler import config
+from guoku_crawler.db import r
+
+
+PHASH_CHUNKS = 4
+PHASH_CHUNK_BITS = 64 / PHASH_CHUNKS
+BUCKET_PREFIX = 'phash.%d.%04x'
+# hash -> "media id width height file path"
+MEDIA_KEY = 'phash.image'
+# hashes of nearly flat images say little about them, and would crowd a
+# few buckets
+MIN_BITS, MAX_BITS = 8, 56
+
+
+def get_dhash(img):
+    """
+    The 64 bit dHash of a decoded image: shrunk to 9x8 grayscale, a bit
+    per pixel brighter than its right neighbour.
+    """
+    with img.clone() as small:
+        small.resize(9, 8)
+        small.depth = 8
+        pixels = bytearray(small.make_blob(format='gray'))
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            i = row * 9 + col
+            dhash = (dhash << 1) | (pixels[i] > pixels[i + 1])
+    return dhash
+
+
+def get_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def get_chunks(dhash):
+    mask = (1 << PHASH_CHUNK_BITS) - 1
+    return [(dhash >> (i * PHASH_CHUNK_BITS)) & mask
+            for i in range(PHASH_CHUNKS)]
+
+
+def is_indexable(dhash):
+    return MIN_BITS <= bin(dhash).count('1') <= MAX_BITS
+
+
+def same_shape(size, other):
+    # cross multiplied, so no side is divided by
+    a, b = size[0] * other[1], other[0] * size[1]
+    return abs(a - b) <= config.IMAGE_DHASH_ASPECT_TOLERANCE * max(a, b)
+
+
+class PerceptualIndex(object):
+
+    def __init__(self, redis_client=r):
+        self.redis = redis_client
+
+    def get_buckets(self, dhash):
+        return [BUCKET_PREFIX % (i, chunk)
+                for i, chunk in enumerate(get_chunks(dhash))]
+
+    def find(self, dhash, size, distance=None):
+        """
+        Returns (media id, file path) of the closest indexed image within
+        `distance` bits of `dhash` and of the shape of `size`, a (width,
+        height), or None.
+        """
+        if not is_indexable(dhash) or not all(size):
+            return None
+        if distance is None:
+            distance = config.IMAGE_DHASH_DISTANCE
+        pipe = self.redis.pipeline(transaction=False)
+        for bucket in self.get_buckets(dhash):
+            pipe.smembers(bucket)
+        candidates = set()
+        for members in pipe.execute():
+            candidates.update(members)
+        members = [member for d, member in sorted(
+            (get_distance(dhash, int(c, 16)), c) for c in candidates)
+            if d <= distance]
+        if not members:
+            return None
+        # the closest image of the same shape
+        for value in self.redis.hmget(MEDIA_KEY, members):
+            if not value:
+                continue
+            media_id, width, height, file_path = value.split(' ', 3)
+            if same_shape(size, (int(width), int(height))):
+                return int(media_id), file_path
+        return None
+
+    def add_many(self, entries):
+        """
+        Index `entries`, (dhash, (width, height), media id, file path)
+        tuples.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for dhash, size, media_id, file_path in entries:
+            if not is_indexable(dhash) or not size or not all(size):
+                continue
+            member = '%016x' % dhash
+            for bucket in self.get_buckets(dhash):
+                pipe.sadd(bucket, member)
+            pipe.hsetnx(MEDIA_KEY, member, '%d %d %d %s' % (
+                media_id, size[0], size[1], file_path))
+        pipe.execute()
+
+
+perceptual_index = PerceptualIndex()
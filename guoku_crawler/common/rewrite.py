@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Find and replace the image urls of article html in one regex pass each,
+without parsing the html into a tree and serializing it back.
+"""
+
+import re
+
+
+# one attribute: a name, optionally = and a quoted or bare value, after
+# whitespace or right after a quoted value
+ATTR_PATTERN = re.compile(
+    r'''(?:\s+|(?<=["']))([^\s"'>/=]+)'''
+    r'''(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?''')
+# an <img> tag, its attributes read in order the same way, so nothing in a
+# quoted value is taken for an attribute or the end of the tag
+IMG_TAG_PATTERN = re.compile(
+    r'''<img((?:(?:\s+|(?<=["']))[^\s"'>/=]+'''
+    r'''(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*)\s*/?>''', re.I)
+SOURCE_ATTRS = ('src', 'data-src')
+
+
+def unescape_attr(value):
+    return (value.replace('&quot;', '"').replace('&#39;', "'")
+            .replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&'))
+
+
+def escape_attr(value):
+    return (value.replace('&', '&amp;').replace('"', '&quot;')
+            .replace('<', '&lt;').replace('>', '&gt;'))
+
+
+def get_image_source(attrs):
+    """
+    The url an <img> tag with the attribute text `attrs` shows: src, else
+    data-src, else None.
+    """
+    sources = {}
+    for match in ATTR_PATTERN.finditer(attrs):
+        name = match.group(1).lower()
+        if name in SOURCE_ATTRS:
+            value = match.group(2) or match.group(3) or match.group(4) or ''
+            sources.setdefault(name, unescape_attr(value))
+    return sources.get('src') or sources.get('data-src')
+
+
+def find_image_sources(html):
+    """
+    The source of every <img> of `html` in document order, None for tags
+    without one.
+    """
+    return [get_image_source(tag.group(1))
+            for tag in IMG_TAG_PATTERN.finditer(html)]
+
+
+def rewrite_images(html, urls):
+    """
+    Point src and data-src of every <img> whose source is a key of `urls`
+    to its value.
+    """
+    if not urls:
+        return html
+
+    def replace(match):
+        tag, attrs = match.group(0), match.group(1)
+        url = urls.get(get_image_source(attrs))
+        if url is None:
+            return tag
+        url = escape_attr(url)
+        kept = ''.join(attr.group(0) for attr in ATTR_PATTERN.finditer(attrs)
+                       if attr.group(1).lower() not in SOURCE_ATTRS)
+        return '<img src="%s" data-src="%s"%s%s' % (
+            url, url, kept, tag[4 + len(attrs):])
+
+    return IMG_TAG_PATTERN.sub(replace, html)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Format and dimensions of an image from the first bytes of its file, so
+trackers, spacers and oversized images are turned down before they are
+downloaded in full or decoded.
+"""
+
+import struct
+
+
+# leading bytes of the formats images are stored in; anything else, an
+# error page served with a 200 say, is not an image
+IMAGE_SIGNATURES = (
+    ('\xff\xd8\xff', 'jpeg'),
+    ('\x89PNG\r\n\x1a\n', 'png'),
+    ('GIF87a', 'gif'),
+    ('GIF89a', 'gif'),
+    ('RIFF', 'webp'),
+    ('BM', 'bmp'),
+    ('II*\x00', 'tiff'),
+    ('MM\x00*', 'tiff'),
+)
+EXTENSIONS = {
+    'jpeg': 'jpg',
+    'png': 'png',
+    'gif': 'gif',
+    'webp': 'webp',
+    'bmp': 'bmp',
+    'tiff': 'tif',
+}
+# start of frame markers, which hold the dimensions of a jpeg
+JPEG_SOF_MARKERS = frozenset([0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                              0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf])
+# markers without a length
+JPEG_BARE_MARKERS = frozenset([0x01, 0xd8] + range(0xd0, 0xd8))
+
+
+def get_image_format(head):
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            if image_format == 'webp' and head[8:12] != 'WEBP':
+                return None
+            return image_format
+
+
+def get_jpeg_size(head):
+    i = 2
+    while i + 4 <= len(head):
+        if head[i] != '\xff':
+            return None
+        marker = ord(head[i + 1])
+        if marker == 0xff:
+            # fill byte
+            i += 1
+            continue
+        if marker in JPEG_BARE_MARKERS:
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if i + 9 > len(head):
+                return None
+            height, width = struct.unpack('>HH', head[i + 5:i + 9])
+            return width, height
+        i += 2 + struct.unpack('>H', head[i + 2:i + 4])[0]
+    return None
+
+
+def get_png_size(head):
+    if len(head) >= 24 and head[12:16] == 'IHDR':
+        return struct.unpack('>II', head[16:24])
+
+
+def get_gif_size(head):
+    if len(head) >= 10:
+        return struct.unpack('<HH', head[6:10])
+
+
+def get_webp_size(head):
+    chunk = head[12:16]
+    if chunk == 'VP8 ' and len(head) >= 30 and head[23:26] == '\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == 'VP8L' and len(head) >= 25 and head[20] == '\x2f':
+        b0, b1, b2, b3 = [ord(c) for c in head[21:25]]
+        return (1 + (b0 | (b1 & 0x3f) << 8),
+                1 + (b1 >> 6 | b2 << 2 | (b3 & 0x0f) << 10))
+    if chunk == 'VP8X' and len(head) >= 30:
+        width = struct.unpack('<I', head[24:27] + '\x00')[0]
+        height = struct.unpack('<I', head[27:30] + '\x00')[0]
+        return width + 1, height + 1
+
+
+def get_bmp_size(head):
+    if len(head) < 26:
+        return None
+    if struct.unpack('<I', head[14:18])[0] == 12:
+        return struct.unpack('<HH', head[18:22])
+    width, height = struct.unpack('<ii', head[18:26])
+    return width, abs(height)
+
+
+SIZE_PARSERS = {
+    'jpeg': get_jpeg_size,
+    'png': get_png_size,
+    'gif': get_gif_size,
+    'webp': get_webp_size,
+    'bmp': get_bmp_size,
+}
+
+
+def sniff(head):
+    """
+    Returns (format, width, height) of the image starting with `head`.
+    The format is None when `head` is not an image, the dimensions None
+    when they are not within `head` or not read for the format.
+    """
+    image_format = get_image_format(head)
+    if image_format not in SIZE_PARSERS:
+        return image_format, None, None
+    size = SIZE_PARSERS[image_format](head)
+    if size is None:
+        return image_format, None, None
+    return image_format, size[0], size[1]
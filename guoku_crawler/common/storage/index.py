@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Names of the files in storage, so existence checks are answered from
+memory instead of a tracker round-trip. Image names are the md5 of their
+content, so a name in the index is an image already stored.
+
+Recently seen names are kept in a local LRU in front of a redis set. Once
+the set is seeded from core_media it is authoritative, and a name missing
+from it is taken to be free; a wrong answer only stores the same content
+under the same key again. Seed it with:
+
+    python -m guoku_crawler.common.storage.index
+"""
+
+import threading
+
+from collections import OrderedDict
+
+from guoku_crawler import config
+from guoku_crawler.config import logger
+from guoku_crawler.db import r, session, iter_batches
+from guoku_crawler.models import CoreMedia
+
+
+NAMES_KEY = 'storage.names'
+
+
+class StorageIndex(object):
+
+    def __init__(self, name=NAMES_KEY, local_size=None, redis_client=r):
+        self.name = name
+        self.local_size = local_size or config.STORAGE_INDEX_LOCAL_SIZE
+        self.redis = redis_client
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = False
+
+    @property
+    def ready_key(self):
+        return self.name + '.ready'
+
+    def is_ready(self):
+        if not self._ready:
+            self._ready = bool(self.redis.exists(self.ready_key))
+        return self._ready
+
+    def remember(self, name):
+        with self._lock:
+            self._local.pop(name, None)
+            self._local[name] = True
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def exists(self, name):
+        """
+        True or False when the index knows, None when the storage has to be
+        asked.
+        """
+        with self._lock:
+            if name in self._local:
+                return True
+        if self.redis.sismember(self.name, name):
+            self.remember(name)
+            return True
+        if self.is_ready():
+            return False
+        return None
+
+    def add(self, name):
+        self.redis.sadd(self.name, name)
+        self.remember(name)
+
+    def discard(self, name):
+        self.redis.srem(self.name, name)
+        with self._lock:
+            self._local.pop(name, None)
+
+    def seed(self, batches):
+        """
+        Load the names of `batches`, lists of names, into a new set and swap
+        it in once complete. Names added meanwhile are carried over.
+        """
+        staging = self.name + '.seed'
+        self.redis.delete(staging)
+        count = 0
+        for batch in batches:
+            if batch:
+                self.redis.sadd(staging, *batch)
+                count += len(batch)
+        if count:
+            self.redis.sunionstore(staging, staging, self.name)
+            self.redis.rename(staging, self.name)
+        self.redis.set(self.ready_key, 1)
+        return count
+
+
+storage_index = StorageIndex()
+
+
+def seed():
+    rows = session.query(CoreMedia.id, CoreMedia.file_path)
+    count = storage_index.seed(
+        [file_path for _, file_path in batch if file_path]
+        for batch in iter_batches(rows, CoreMedia.id))
+    logger.info('seeded the storage index with %d names', count)
+    return count
+
+
+if __name__ == '__main__':
+    print 'names: %d' % seed()
@@ -13,6 +13,7 @@ from urlparse import urljoin
 
 from guoku_crawler import config
 from guoku_crawler.common.storage import locks
+from guoku_crawler.common.storage.index import storage_index
 from guoku_crawler.common.storage.file import File
 from guoku_crawler.common.storage._os import safe_join
 from guoku_crawler.common.storage.move import file_move_safe
@@ -353,7 +354,13 @@ class MogileFSStorage(Storage):
         # return f
 
     def exists(self, file_name):
-        return bool(self.client.get_paths(file_name))
+        known = storage_index.exists(file_name)
+        if known is not None:
+            return known
+        if self.client.get_paths(file_name):
+            storage_index.add(file_name)
+            return True
+        return False
         # return file_name in self.client
 
     def save(self, file_name, raw_contents):
@@ -365,6 +372,7 @@ class MogileFSStorage(Storage):
         # Write the file to mogile
         success = self.client.store_file(file_name, raw_contents, cls=self.mogile_class)
         if success:
+            storage_index.add(file_name)
             print "Wrote file to key %s, %s@%s" % (file_name, self.domain, self.trackers[0])
         else:
             print "FAILURE writing file %s" % (file_name)
@@ -373,6 +381,7 @@ class MogileFSStorage(Storage):
 
     def delete(self, file_name):
         print file_name
+        storage_index.discard(file_name)
         return self.client.delete(file_name)
 
 #
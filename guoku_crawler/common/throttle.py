@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from urlparse import urlparse
+from redis.exceptions import RedisError
+
+from guoku_crawler import config
+from guoku_crawler.config import logger
+from guoku_crawler.db import r
+from guoku_crawler.exceptions import Throttled
+
+
+def get_host(url):
+    return urlparse(url).netloc.lower()
+
+
+class HostThrottle(object):
+    """
+    Per-host politeness. Requests to the same host are spaced at least
+    `interval` seconds apart; requests to different hosts never wait on
+    each other.
+    """
+
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = config.REQUEST_INTERVAL
+        self.interval = interval
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, url):
+        """
+        Take the slot for the host of `url` if it is free now, otherwise
+        raise `Throttled` with the seconds until it is.
+        """
+        host = get_host(url)
+        with self._lock:
+            now = time.time()
+            slot = self._next_slot.get(host, 0)
+            if slot <= now:
+                self._next_slot[host] = now + self.interval
+        if slot > now:
+            raise Throttled(countdown=slot - now,
+                            message=u'rate limited on %s.' % host)
+
+
+# Take one token from the bucket in KEYS[1]. The bucket refills at ARGV[1]
+# tokens/s up to ARGV[2] tokens. Returns 0 when a token was taken, otherwise
+# the seconds until one is available; nothing is taken in that case.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+if tokens < 1 then
+    return tostring((1 - tokens) / rate)
+end
+tokens = tokens - 1
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1],
+           math.ceil((burst - tokens) / rate * 1000) + 1000)
+return '0'
+"""
+
+
+class TokenBucket(object):
+    """
+    Token bucket per host, kept in redis and shared by every worker, so the
+    request rate to a host stays the same however many workers are running.
+
+    Rates come from `config.HOST_RATE_LIMITS` (host -> (rate, burst)); hosts
+    without an entry get one request per `config.REQUEST_INTERVAL`. A request
+    finding the bucket empty raises `Throttled` instead of sleeping, so the
+    worker is free until the task is retried. If redis is unreachable we fall
+    back to the in-process `HostThrottle`.
+    """
+
+    def __init__(self, redis_client=r):
+        self.redis = redis_client
+        self.script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.fallback = HostThrottle()
+
+    @staticmethod
+    def get_limit(host):
+        rate, burst = config.HOST_RATE_LIMITS.get(
+            host, (1.0 / config.REQUEST_INTERVAL, 1))
+        return float(rate), burst
+
+    def reserve(self, url):
+        host = get_host(url)
+        rate, burst = self.get_limit(host)
+        try:
+            wait = float(self.script(keys=['throttle.%s' % host],
+                                     args=[rate, burst, time.time()]))
+        except RedisError as e:
+            logger.error('token bucket unavailable, throttle locally: %s', e)
+            return self.fallback.reserve(url)
+        if wait > 0:
+            raise Throttled(countdown=wait,
+                            message=u'rate limited on %s.' % host)
+
+
+default_throttle = TokenBucket()
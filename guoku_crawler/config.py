@@ -20,6 +20,8 @@ DATABASES = {
     'HOST': '10.0.2.90',
     'PORT': '3306',
 }
+# Overrides DATABASES with any sqlalchemy url, e.g. sqlite for benchmarks.
+DATABASE_URI = ''
 
 # Image
 IMAGE_HOST = 'http://imgcdn.guoku.com/'
@@ -40,12 +42,19 @@ DEFAULT_ARTICLE_COVER = "%s%s" % (
 # System
 DEBUG = True
 CONNECTION_POOL = ''
+# Append every crawler response to this file; see guoku_crawler.bench
+CASSETTE_RECORD_PATH = ''
+# Push per-stage timings to redis for guoku_crawler.bench.pipeline
+BENCH_METRICS = False
 PHANTOM_SERVER = 'http://10.0.2.49:5000/'
 
 # Celery
 BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERYD_CONCURRENCY = 2
+# Processes of the worker serving the default queue, whose tasks mostly wait
+# on the network; see entry.sh.
+CELERYD_NETWORK_CONCURRENCY = 16
 CELERY_DISABLE_RATE_LIMITS = False
 CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
 CELERY_ALWAYS_EAGER = False
@@ -62,21 +71,19 @@ CELERY_ROUTES = {
     'weixin.update_sogou_cookie':
         {
             'queue': 'cookies'
-        }
+        },
+    'image.transcode':
+        {
+            'queue': 'images'
+        },
 }
+# Calls per message when a list task publishes its children; 1 keeps one
+# message, and celery retries, per call.
+DISPATCH_CHUNK_SIZE = 1
 CELERY_ANNOTATIONS = {
     'crawl_articles': {
         'rate_limit': '1/m',
     },
-    'rss.crawl_list': {
-        'rate_limit': '3/m',
-    },
-    'weixin.crawl_list': {
-        'rate_limit': '1/m',
-    },
-    'weixin.crawl_weixin_article': {
-        'rate_limit': '1/m',
-    },
     'weixin.prepare_sogou_cookies': {
         'rate_limit': '1/m',
     },
@@ -85,11 +92,104 @@ CELERY_ANNOTATIONS = {
     },
 }
 REQUEST_INTERVAL = 20
+# Cluster-wide request rate per host: host -> (requests per second, burst).
+# Hosts not listed here get one request per REQUEST_INTERVAL.
+HOST_RATE_LIMITS = {
+    'weixin.sogou.com': (1 / 60.0, 1),
+    'mp.weixin.qq.com': (1 / 20.0, 3),
+    'mmbiz.qpic.cn': (2, 10),
+    'mmbiz.qlogo.cn': (2, 10),
+}
+# A task whose host has no token left is retried once one is due, plus up to
+# as much again of jitter; these retries have their own, larger, allowance.
+THROTTLE_MAX_RETRIES = 50
+# Retries back off exponentially with full jitter, up to RETRY_BACKOFF_MAX.
+TASK_MAX_RETRIES = 5
+RETRY_BACKOFF_BASE = 45
+RETRY_BACKOFF_MAX = 60 * 60
+# A host failing CIRCUIT_FAILURE_THRESHOLD times within CIRCUIT_FAILURE_WINDOW
+# seconds is not requested for CIRCUIT_COOLDOWN seconds, doubled on every
+# trip up to CIRCUIT_COOLDOWN_MAX.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_FAILURE_WINDOW = 5 * 60
+CIRCUIT_COOLDOWN = 60
+CIRCUIT_COOLDOWN_MAX = 60 * 60
+CIRCUIT_PROBE_TIMEOUT = 60
+RSS_CACHE_TTL = 60 * 60 * 24 * 7
+# Images of an article are fetched IMAGE_FETCH_WORKERS at a time, at most
+# IMAGE_FETCH_PER_HOST (or the host's entry below) from the same CDN.
+IMAGE_FETCH_WORKERS = 8
+IMAGE_FETCH_PER_HOST = 2
+IMAGE_FETCH_HOST_LIMITS = {
+    'mmbiz.qpic.cn': 4,
+    'mmbiz.qlogo.cn': 4,
+}
+# Downloaded images are kept in memory up to this many bytes, on disk beyond.
+IMAGE_SPOOL_MAX_SIZE = 512 * 1024
+# The format and dimensions of an image are read from its first
+# IMAGE_SNIFF_BYTES, looking as far as IMAGE_SNIFF_MAX_BYTES for those of a
+# jpeg. Images with a side under IMAGE_MIN_SIDE (trackers, spacers), over
+# IMAGE_MAX_PIXELS or over IMAGE_MAX_DOWNLOAD bytes are not stored.
+IMAGE_SNIFF_BYTES = 4 * 1024
+IMAGE_SNIFF_MAX_BYTES = 64 * 1024
+IMAGE_MIN_SIDE = 8
+IMAGE_MAX_PIXELS = 40 * 1000 * 1000
+IMAGE_MAX_DOWNLOAD = 20 * 1024 * 1024
+# Where images that must be decoded (converted or cropped) are handled:
+# 'celery' stages them in storage under IMAGE_STAGING_PATH for the images
+# queue, served by image_worker with one process per core, and the article
+# is rewritten once they are stored; 'inline' handles them in the task that
+# downloaded them. Images that only need their derivatives are resized
+# there either way.
+IMAGE_EXECUTOR = 'celery'
+IMAGE_STAGING_PATH = 'staging/'
+# Re-encoding, see guoku_crawler.common.compress: jpeg or webp, at the
+# lowest quality of IMAGE_QUALITY_RANGE reaching IMAGE_TARGET_SSIM, and
+# lower still to fit IMAGE_MAX_BYTES (0 for no budget). Jpeg and webp
+# images are only re-encoded above IMAGE_RECOMPRESS_MIN_BYTES.
+IMAGE_OUTPUT_FORMAT = 'jpeg'
+IMAGE_QUALITY_RANGE = (50, 92)
+IMAGE_TARGET_SSIM = 0.98
+IMAGE_MAX_BYTES = 400 * 1024
+IMAGE_RECOMPRESS_MIN_BYTES = 200 * 1024
+# Images within this many bits of the dHash of a stored image, and within
+# this fraction of its aspect ratio, are taken to be it; keep the distance
+# below 4, see guoku_crawler.common.phash.
+IMAGE_DHASH_DISTANCE = 3
+IMAGE_DHASH_ASPECT_TOLERANCE = 0.02
+# Smaller copies stored next to every image, from the same decode, as
+# images/<name>/<md5>.<ext of IMAGE_OUTPUT_FORMAT>: (name, width, square
+# crop).
+IMAGE_DERIVATIVES = (
+    ('800w', 800, False),
+    ('300w', 300, False),
+    ('square', 300, True),
+)
+
+# Query parameters that do not change which image a source url points to;
+# on the WeChat CDNs the scheme and IMAGE_SOURCE_WEIXIN_PARAMS don't either.
+IMAGE_SOURCE_NOISE_PARAMS = ('wxfrom', 'wx_lazy', 'wx_co', 'tp', 'from',
+                             'spm')
+IMAGE_SOURCE_WEIXIN_HOSTS = ('mmbiz.qpic.cn', 'mmbiz.qlogo.cn',
+                             'mmsns.qpic.cn')
+IMAGE_SOURCE_WEIXIN_PARAMS = ('wx_fmt',)
+# Bloom filter of crawled articles. A false positive skips a new article, so
+# keep the error rate low and the capacity ahead of the table size; rebuild
+# with `make rebuild-seen` after raising either.
+SEEN_ARTICLES_CAPACITY = 500000
+SEEN_ERROR_RATE = 0.0001
+# Stored file names each worker keeps in memory in front of the redis index;
+# seed the index with `make seed-storage-index`.
+STORAGE_INDEX_LOCAL_SIZE = 20000
 CELERYBEAT_SCHEDULE = {
     'crawl_all_articles': {
         'task': 'crawl_articles',
         'schedule': crontab(minute='*/10')
     },
+    'refresh_sogou_cookies': {
+        'task': 'weixin.refresh_sogou_cookies',
+        'schedule': crontab(minute='*/5')
+    },
 }
 
 # Redis
@@ -135,6 +235,27 @@ SOGOU_USERS = [
 
 ]
 SOGOU_PASSWORD = 'guoku1@#'
+# Cookie pool: a user that hits a captcha rests for SOGOU_COOKIE_QUARANTINE
+# seconds. Users are rotated least recently used first, pushed back by up to
+# SOGOU_COOKIE_HEALTH_PENALTY seconds for a poor recent success rate and by
+# SOGOU_COOKIE_AGE_WEIGHT seconds per second of cookie age.
+SOGOU_COOKIE_QUARANTINE = 30 * 60
+SOGOU_COOKIE_HEALTH_PENALTY = 10 * 60
+SOGOU_COOKIE_HEALTH_ALPHA = 0.2
+SOGOU_COOKIE_AGE_WEIGHT = 0.1
+# Cookies are renewed once they reach SOGOU_COOKIE_RENEW_AT of their observed
+# lifetime (SOGOU_COOKIE_LIFETIME until we have seen one go bad), at most one
+# request to the phantom server every PHANTOM_COOKIE_SPACING seconds.
+SOGOU_COOKIE_LIFETIME = 6 * 60 * 60
+SOGOU_COOKIE_LIFETIME_ALPHA = 0.2
+SOGOU_COOKIE_RENEW_AT = 0.8
+SOGOU_COOKIE_REFRESH_INTERVAL = 5 * 60
+PHANTOM_COOKIE_SPACING = 60
+# Sogou profile links are cached until a fetch reports them expired; the TTLs
+# only bound how long a stale link can linger. Workers keep their own copy for
+# PROFILE_LINK_LOCAL_TTL seconds.
+PROFILE_LINK_TTL = 7 * 24 * 60 * 60
+PROFILE_LINK_LOCAL_TTL = 10 * 60
 
 
 
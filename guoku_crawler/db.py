@@ -8,7 +8,8 @@ from guoku_crawler import config
 from guoku_crawler.config import DATABASES
 
 
-SQLALCHEMY_DATABASE_URI = ('mysql+pymysql://{USER}:{PASSWORD}@'
+SQLALCHEMY_DATABASE_URI = (config.DATABASE_URI or
+                           'mysql+pymysql://{USER}:{PASSWORD}@'
                            '{HOST}:{PORT}/{DB_NAME}?charset=utf8mb4'.
                            format(**DATABASES))
 engine = create_engine(
@@ -19,3 +20,15 @@ session = Session(engine)
 r = redis.Redis(host=config.CONFIG_REDIS_HOST,
                 port=config.CONFIG_REDIS_PORT,
                 db=config.CONFIG_REDIS_DB)
+
+
+def iter_batches(query, id_column, batch_size=10000):
+    # keyset pagination; the first column of every row is `id_column`
+    last_id = 0
+    while True:
+        rows = query.filter(id_column > last_id).order_by(
+            id_column).limit(batch_size).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield rows
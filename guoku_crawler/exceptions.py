@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import math
+
 
 class Retry(Exception):
     def __init__(self, countdown=5, message=u''):
@@ -8,6 +10,18 @@ class Retry(Exception):
         self.message = 'Fetch error, need to login or get new token.' + message
 
 
+class CircuitOpen(Retry):
+    def __init__(self, countdown=60, message=u''):
+        self.countdown = countdown
+        self.message = message
+
+
+class Throttled(Retry):
+    def __init__(self, countdown=1, message=u''):
+        self.countdown = int(math.ceil(countdown))
+        self.message = message
+
+
 class Expired(Exception):
     def __init__(self, message=u''):
         self.message = message
@@ -16,3 +30,8 @@ class Expired(Exception):
 class TooManyRequests(Exception):
     def __init__(self, message=u''):
         self.message = message
+
+
+class ImageRejected(Exception):
+    def __init__(self, message=u''):
+        self.message = message
@@ -96,3 +96,18 @@ class CoreMedia(Base):
     content_type = Column(String(30), nullable=False)
     upload_datetime = Column(DateTime, index=True)
     creator_id = Column(Integer)
+
+
+class CrawlerImageSource(Base):
+    """
+    Where a stored image was downloaded from. Owned by the crawler; create
+    it with `python -m guoku_crawler.common.image_source`.
+    """
+    __tablename__ = 'crawler_image_source'
+
+    id = Column(Integer, primary_key=True)
+    source_hash = Column(String(32), nullable=False, unique=True)
+    source_url = Column(String(1024), nullable=False)
+    media_id = Column(ForeignKey('core_media.id'), nullable=False, index=True)
+
+    media = relationship('CoreMedia')
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+import redis
+
+from redis.exceptions import RedisError
+
+
+# a scratch database: it is flushed around every test using it
+TEST_REDIS_URL = os.environ.get('GK_TEST_REDIS_URL',
+                                'redis://localhost:6379/15')
+
+
+class Clock(object):
+    """
+    Stands in for the `time` module of the code under test.
+    """
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def redis_client():
+    """
+    The redis at GK_TEST_REDIS_URL, emptied. The Lua scripts need a real
+    server; tests using it are skipped when none answers.
+    """
+    client = redis.Redis.from_url(TEST_REDIS_URL)
+    try:
+        client.ping()
+    except RedisError as e:
+        pytest.skip('no redis at %s: %s' % (TEST_REDIS_URL, e))
+    client.flushdb()
+    yield client
+    client.flushdb()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from guoku_crawler import config
+from guoku_crawler.article import cookies
+from guoku_crawler.article.cookies import CookiePool, POOL_KEY
+
+
+@pytest.fixture
+def pool(redis_client, clock, monkeypatch):
+    monkeypatch.setattr(cookies, 'time', clock)
+    monkeypatch.setattr(config, 'SOGOU_USERS', ['a', 'b', 'c'])
+    return CookiePool(redis_client)
+
+
+def test_empty_pool(pool):
+    assert pool.checkout() == (None, None)
+
+
+def test_checkout_rotates(pool, clock):
+    pool.add('a', 'cookie-a')
+    clock.advance(1)
+    pool.add('b', 'cookie-b')
+    clock.advance(1)
+    assert pool.checkout() == ('a', 'cookie-a')
+    clock.advance(1)
+    assert pool.checkout() == ('b', 'cookie-b')
+    clock.advance(1)
+    assert pool.checkout() == ('a', 'cookie-a')
+
+
+def test_quarantine(pool, clock):
+    pool.add('a', 'cookie-a')
+    pool.add('b', 'cookie-b')
+    pool.quarantine('a', seconds=60)
+    for _ in range(3):
+        clock.advance(1)
+        assert pool.checkout()[0] == 'b'
+    clock.advance(60)
+    # back in the pool as used when its quarantine ended
+    assert [pool.checkout()[0] for _ in range(3)] == ['b', 'a', 'b']
+
+
+def test_unhealthy_user_comes_round_less(pool, clock):
+    pool.add('a', 'cookie-a')
+    pool.add('b', 'cookie-b')
+    clock.advance(1)
+    pool.checkout()
+    pool.checkout()
+    health = pool.checkin('a', ok=False)
+    assert health == pytest.approx(1 - config.SOGOU_COOKIE_HEALTH_ALPHA)
+    assert pool.checkin('b') == 1
+    clock.advance(1)
+    assert pool.checkout()[0] == 'b'
+
+
+def test_user_without_cookie_dropped(pool, redis_client):
+    pool.add('a', 'cookie-a')
+    pool.add('b', 'cookie-b')
+    redis_client.delete(pool.get_cookie_key('a'))
+    assert pool.checkout()[0] == 'b'
+    assert redis_client.zscore(POOL_KEY, 'a') is None
+
+
+def test_sync(pool, redis_client):
+    redis_client.set(pool.get_cookie_key('a'), 'cookie-a')
+    redis_client.set(pool.get_cookie_key('c'), 'cookie-c')
+    pool.add('b', 'cookie-b')
+    pool.quarantine('c')
+    assert pool.sync() == 1
+    assert redis_client.zscore(POOL_KEY, 'a') is not None
+    assert redis_client.zscore(POOL_KEY, 'c') is None
+
+
+def test_lifetime(pool, clock):
+    assert pool.get_lifetime() == config.SOGOU_COOKIE_LIFETIME
+    pool.add('a', 'cookie-a')
+    clock.advance(3600)
+    pool.quarantine('a')
+    alpha = config.SOGOU_COOKIE_LIFETIME_ALPHA
+    assert pool.get_lifetime() == pytest.approx(
+        config.SOGOU_COOKIE_LIFETIME * (1 - alpha) + 3600 * alpha)
+    assert pool.get_ages(['a', 'b']) == {'a': 3600, 'b': None}
+
+
+def test_claim_refresh(pool):
+    spacing = config.PHANTOM_COOKIE_SPACING
+    assert pool.claim_refresh('a') == 0
+    assert pool.claim_refresh('a') is None
+    assert pool.claim_refresh('b') == spacing
+    assert pool.claim_refresh('c', delay=10 * spacing) == 10 * spacing
+
+
+def test_add_ends_refresh(pool):
+    pool.claim_refresh('a')
+    pool.add('a', 'cookie-a')
+    assert pool.claim_refresh('a') is not None
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from guoku_crawler.common.image_source import get_source_hash
+from guoku_crawler.common.image_source import normalize_source_url
+
+
+def test_weixin_scheme_and_format_dropped():
+    assert (normalize_source_url(
+        'https://MMBIZ.qpic.cn/mmbiz_jpg/abc/640?wx_fmt=jpeg&wxfrom=5') ==
+        'http://mmbiz.qpic.cn/mmbiz_jpg/abc/640')
+
+
+def test_noise_params_dropped_and_sorted():
+    assert (normalize_source_url(
+        'http://img.example.com/a.jpg?w=2&utm_source=x&spm=1&h=1#top') ==
+        'http://img.example.com/a.jpg?h=1&w=2')
+
+
+def test_other_hosts_keep_scheme_and_format():
+    assert (normalize_source_url('https://img.example.com/a?wx_fmt=png') ==
+            'https://img.example.com/a?wx_fmt=png')
+
+
+def test_unicode_url():
+    url = normalize_source_url(u' http://img.example.com/图.jpg ')
+    assert isinstance(url, str)
+    assert url == u'http://img.example.com/图.jpg'.encode('utf-8')
+
+
+def test_hash_of_equivalent_urls():
+    assert (get_source_hash('http://mmbiz.qpic.cn/a/0?wx_fmt=gif&tp=webp') ==
+            get_source_hash('https://mmbiz.qpic.cn/a/0'))
+    assert (get_source_hash('http://mmbiz.qpic.cn/a/0') !=
+            get_source_hash('http://mmbiz.qpic.cn/b/0'))
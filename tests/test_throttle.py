@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from redis.exceptions import RedisError
+
+from guoku_crawler import config
+from guoku_crawler.common import throttle
+from guoku_crawler.common.throttle import HostThrottle, TokenBucket
+from guoku_crawler.exceptions import Retry, Throttled
+
+
+@pytest.fixture
+def bucket(redis_client, clock, monkeypatch):
+    monkeypatch.setattr(throttle, 'time', clock)
+    monkeypatch.setattr(config, 'HOST_RATE_LIMITS',
+                        {'img.example.com': (2, 3)})
+    monkeypatch.setattr(config, 'REQUEST_INTERVAL', 20)
+    return TokenBucket(redis_client)
+
+
+def test_burst_then_throttled(bucket):
+    for _ in range(3):
+        assert bucket.reserve('http://img.example.com/a.jpg') is None
+    with pytest.raises(Throttled) as e:
+        bucket.reserve('http://img.example.com/b.jpg')
+    assert e.value.countdown == 1
+    assert isinstance(e.value, Retry)
+
+
+def test_refill(bucket, clock):
+    for _ in range(3):
+        bucket.reserve('http://img.example.com/a.jpg')
+    clock.advance(0.5)
+    bucket.reserve('http://img.example.com/a.jpg')
+    with pytest.raises(Throttled):
+        bucket.reserve('http://img.example.com/a.jpg')
+
+
+def test_throttled_request_takes_no_token(bucket, clock):
+    for _ in range(3):
+        bucket.reserve('http://img.example.com/a.jpg')
+    for _ in range(5):
+        with pytest.raises(Throttled):
+            bucket.reserve('http://img.example.com/a.jpg')
+    clock.advance(0.5)
+    bucket.reserve('http://img.example.com/a.jpg')
+
+
+def test_refill_capped_at_burst(bucket, clock):
+    clock.advance(3600)
+    for _ in range(3):
+        bucket.reserve('http://img.example.com/a.jpg')
+    with pytest.raises(Throttled):
+        bucket.reserve('http://img.example.com/a.jpg')
+
+
+def test_hosts_are_independent(bucket):
+    for _ in range(3):
+        bucket.reserve('http://img.example.com/a.jpg')
+    bucket.reserve('http://other.example.com/')
+    with pytest.raises(Throttled) as e:
+        bucket.reserve('http://other.example.com/')
+    assert e.value.countdown == 20
+
+
+def test_local_fallback(bucket, clock):
+    def unavailable(keys, args):
+        raise RedisError('down')
+    bucket.script = unavailable
+    bucket.reserve('http://img.example.com/a.jpg')
+    with pytest.raises(Throttled):
+        bucket.reserve('http://img.example.com/a.jpg')
+
+
+def test_host_throttle(clock, monkeypatch):
+    monkeypatch.setattr(throttle, 'time', clock)
+    host_throttle = HostThrottle(interval=5)
+    host_throttle.reserve('http://a.example.com/1')
+    host_throttle.reserve('http://b.example.com/1')
+    clock.advance(2)
+    with pytest.raises(Throttled) as e:
+        host_throttle.reserve('http://A.example.com/2')
+    assert e.value.countdown == 3
+    clock.advance(3)
+    host_throttle.reserve('http://a.example.com/2')